@@ -2,70 +2,325 @@
 Buddy AI Assistant - Complete Working Version
 """
 
+import time
+STARTED = time.perf_counter()
+
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, filedialog, simpledialog
 import datetime
 import threading
-import base64
+import queue
+import math
+import wave
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import requests
-import json
+import os
+import re
 import sys
-import time
-from collections import deque
+
+from buddy_engine import (
+    module_available, LazyModule, BuddyEngine, DEFAULT_TOPICS, read_batch_items,
+    GEMINI_AVAILABLE, PDF_AVAILABLE, PIL_AVAILABLE, NUMPY_AVAILABLE, np,
+)
 
 if sys.platform == "win32":
     import io
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
 
-try:
-    import speech_recognition as sr
-    SR_AVAILABLE = True
-except ImportError:
-    SR_AVAILABLE = False
-
-try:
-    import pyttsx3
-    TTS_AVAILABLE = True
-except ImportError:
-    TTS_AVAILABLE = False
-
-try:
-    import pywhatkit
-    PYWHATKIT_AVAILABLE = True
-except ImportError:
-    PYWHATKIT_AVAILABLE = False
-
-try:
-    import wikipedia
-    WIKI_AVAILABLE = True
-except ImportError:
-    WIKI_AVAILABLE = False
-
-try:
-    import pyjokes
-    JOKES_AVAILABLE = True
-except ImportError:
-    JOKES_AVAILABLE = False
-
-try:
-    from google import genai
-    GEMINI_AVAILABLE = True
-except ImportError:
-    GEMINI_AVAILABLE = False
-
-try:
-    import PyPDF2
-    PDF_AVAILABLE = True
-except ImportError:
-    PDF_AVAILABLE = False
-
-try:
-    from PIL import Image
-    PIL_AVAILABLE = True
-except ImportError:
-    PIL_AVAILABLE = False
+# Availability is a cheap find_spec lookup; nothing is imported until used
+SR_AVAILABLE = module_available("speech_recognition")
+sr = LazyModule("speech_recognition")
+
+TTS_AVAILABLE = module_available("pyttsx3")
+pyttsx3 = LazyModule("pyttsx3")
+
+PYWHATKIT_AVAILABLE = module_available("pywhatkit")
+pywhatkit = LazyModule("pywhatkit")
+
+WIKI_AVAILABLE = module_available("wikipedia")
+wikipedia = LazyModule("wikipedia")
+
+COMPARE_LABEL = "Compare all models"
+
+SENTENCE_END = re.compile(r"(?<=[.!?])[\"')\]]*\s+|\n\s*\n|\n(?=\s*(?:[-*\u2022]|\d+\.)\s)")
+MARKDOWN_NOISE = re.compile(r"[*_`#>|]+")
+
+
+def split_sentences(text, final=False, max_chars=300):
+    # Returns (complete sentences, unfinished remainder). A long run with no
+    # sentence end is cut at a space so speech can still start.
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        sentences.append(text[start:match.start()])
+        start = match.end()
+    rest = text[start:]
+    while len(rest) > max_chars:
+        cut = rest.rfind(" ", 0, max_chars)
+        cut = cut if cut > 0 else max_chars
+        sentences.append(rest[:cut])
+        rest = rest[cut:]
+    if final:
+        sentences.append(rest)
+        rest = ""
+    sentences = [" ".join(MARKDOWN_NOISE.sub(" ", sentence).split()) for sentence in sentences]
+    return [sentence for sentence in sentences if any(c.isalnum() for c in sentence)], rest
+
+
+class SpeechWorker:
+    # One long-lived thread owns the pyttsx3 engine, which is not thread-safe.
+    # Text is fed in as it arrives (streamed chunks or a whole reply), split
+    # into sentences and queued, so the first sentence is spoken while the
+    # rest is still coming. The queue is bounded: sentences that do not fit
+    # are dropped rather than left to pile up. interrupt() discards what is
+    # queued and stops the current sentence at the next word; it returns a
+    # generation token, and text fed with an older token is dropped, so a
+    # reply that finishes after the interrupt stays quiet.
+    def __init__(self, create_engine, max_sentences=24):
+        self.create_engine = create_engine
+        self.sentences = queue.Queue(maxsize=max_sentences)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.speaking = None
+        self.buffer = ""
+        self.engine = None
+        self.thread = None
+
+    def feed(self, text, final=False, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            sentences, self.buffer = split_sentences(self.buffer + text, final)
+            generation = self.generation
+            if self.thread is None and sentences:
+                self.thread = threading.Thread(target=self.run, name="buddy-tts", daemon=True)
+                self.thread.start()
+        for sentence in sentences:
+            try:
+                self.sentences.put_nowait((generation, sentence))
+            except queue.Full:
+                break
+
+    def speak(self, text, generation=None):
+        self.feed(text, final=True, generation=generation)
+
+    def interrupt(self):
+        with self.lock:
+            self.generation += 1
+            self.buffer = ""
+            generation = self.generation
+        while True:
+            try:
+                self.sentences.get_nowait()
+            except queue.Empty:
+                break
+        return generation
+
+    def close(self):
+        self.interrupt()
+        if self.thread is not None:
+            try:
+                self.sentences.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def on_word(self, name, location, length):
+        # Runs inside runAndWait on the worker thread, where stop() is safe
+        if self.speaking != self.generation:
+            self.engine.stop()
+
+    def run(self):
+        self.engine = self.create_engine()
+        if self.engine is None:
+            return
+        try:
+            self.engine.connect("started-word", self.on_word)
+        except Exception:
+            pass
+        while True:
+            item = self.sentences.get()
+            if item is None:
+                return
+            generation, sentence = item
+            if generation != self.generation:
+                continue
+            self.speaking = generation
+            try:
+                self.engine.say(sentence)
+                self.engine.runAndWait()
+            except Exception as e:
+                print(f"TTS error: {e}")
+
+
+class WaveFileSource:
+    # Minimal stand-in for sr.AudioFile (16-bit PCM WAV only) so recorded
+    # audio can drive VoiceCapture without speech_recognition installed
+    CHUNK = 4096
+
+    def __init__(self, path):
+        self.path = path
+        self.stream = None
+
+    def __enter__(self):
+        self.stream = wave.open(str(self.path), "rb")
+        if self.stream.getsampwidth() != 2 or self.stream.getnchannels() != 1:
+            self.stream.close()
+            raise ValueError("expected 16-bit mono WAV")
+        self.SAMPLE_RATE = self.stream.getframerate()
+        self.SAMPLE_WIDTH = 2
+        self.stream.read = self.stream.readframes
+        return self
+
+    def __exit__(self, *exc):
+        self.stream.close()
+
+
+def open_audio_file(path):
+    return sr.AudioFile(str(path)) if SR_AVAILABLE else WaveFileSource(path)
+
+
+class VoiceCapture:
+    """Continuous voice input.
+
+    run() reads fixed-size frames from an open source (sr.Microphone,
+    sr.AudioFile or WaveFileSource: anything with ``stream.read(frames)``,
+    ``SAMPLE_RATE`` and ``SAMPLE_WIDTH``) until stopped or the audio ends.
+    The noise floor is measured once, from the first ``calibrate`` seconds,
+    and kept for later runs. A frame counts as speech when its RMS energy is
+    ``threshold_ratio`` times the floor; an utterance ends after ``hang``
+    seconds of quiet. Each utterance is recognised on a small thread pool so
+    capture never waits for the (network) recogniser, and ``on_text`` gets
+    the transcripts in the order they were spoken.
+
+    ``recognize(pcm, sample_rate, sample_width)`` returns text, or None for
+    nothing intelligible.
+    """
+
+    DTYPES = {1: "int8", 2: "int16", 4: "int32"}
+
+    def __init__(self, recognize, on_text, on_error=None, frame_ms=30, calibrate=0.5,
+                 threshold_ratio=3.0, min_threshold=200.0, hang=0.6, min_speech=0.25,
+                 max_utterance=15.0, pre_roll=0.2, workers=2):
+        self.recognize = recognize
+        self.on_text = on_text
+        self.on_error = on_error
+        self.frame_ms = frame_ms
+        self.calibrate = calibrate
+        self.threshold_ratio = threshold_ratio
+        self.min_threshold = min_threshold
+        self.hang = hang
+        self.min_speech = min_speech
+        self.max_utterance = max_utterance
+        self.pre_roll = pre_roll
+        self.threshold = None
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="buddy-voice")
+        self.pending = deque()
+        self.pending_lock = threading.Lock()
+        self.segments = []
+
+    def frame_energies(self, data, width, frame_samples):
+        # RMS energy of each whole frame in data
+        count = len(data) // (width * frame_samples)
+        if NUMPY_AVAILABLE:
+            samples = np.frombuffer(data, dtype=self.DTYPES[width], count=count * frame_samples)
+            frames = samples.reshape(count, frame_samples).astype(np.float64)
+            return np.sqrt(np.mean(frames * frames, axis=1)).tolist()
+        samples = array({1: "b", 2: "h", 4: "i"}[width], data[:count * frame_samples * width])
+        return [math.sqrt(sum(x * x for x in samples[i:i + frame_samples]) / frame_samples)
+                for i in range(0, len(samples), frame_samples)]
+
+    def run(self, source, stop=None, frames_per_read=1):
+        # Blocks until stop is set or the source runs dry; returns the
+        # number of utterances handed to the recogniser
+        rate, width = source.SAMPLE_RATE, source.SAMPLE_WIDTH
+        frame_samples = max(1, rate * self.frame_ms // 1000)
+        frame_bytes = frame_samples * width
+        frame_seconds = frame_samples / rate
+        hang_frames = max(1, round(self.hang / frame_seconds))
+        min_frames = max(1, round(self.min_speech / frame_seconds))
+        max_frames = max(1, round(self.max_utterance / frame_seconds))
+        calibration = [] if self.threshold is None else None
+        calibration_frames = max(1, round(self.calibrate / frame_seconds))
+        before = deque(maxlen=max(1, round(self.pre_roll / frame_seconds)))
+        utterance = []
+        quiet = 0
+        voiced = 0
+        position = 0
+        submitted = 0
+        leftover = b""
+        
+        while stop is None or not stop.is_set():
+            data = source.stream.read(frame_samples * frames_per_read)
+            if not data:
+                break
+            data = leftover + data
+            usable = len(data) - len(data) % frame_bytes
+            leftover = data[usable:]
+            for index, energy in enumerate(self.frame_energies(data[:usable], width, frame_samples)):
+                frame = data[index * frame_bytes:(index + 1) * frame_bytes]
+                position += 1
+                if calibration is not None:
+                    calibration.append(energy)
+                    if len(calibration) >= calibration_frames:
+                        floor = sorted(calibration)[len(calibration) // 2]
+                        self.threshold = max(self.min_threshold, floor * self.threshold_ratio)
+                        calibration = None
+                    continue
+                speech = energy >= self.threshold
+                if not utterance:
+                    if speech:
+                        utterance = list(before) + [frame]
+                        voiced, quiet = 1, 0
+                    else:
+                        before.append(frame)
+                    continue
+                utterance.append(frame)
+                if speech:
+                    voiced += 1
+                    quiet = 0
+                else:
+                    quiet += 1
+                if quiet >= hang_frames or len(utterance) >= max_frames:
+                    if voiced >= min_frames:
+                        self.submit(b"".join(utterance), rate, width,
+                                    (position - len(utterance)) * frame_seconds, position * frame_seconds)
+                        submitted += 1
+                    utterance = []
+                    before.clear()
+        if utterance and voiced >= min_frames:
+            self.submit(b"".join(utterance), rate, width,
+                        (position - len(utterance)) * frame_seconds, position * frame_seconds)
+            submitted += 1
+        return submitted
+
+    def submit(self, pcm, rate, width, start, end):
+        self.segments.append((start, end))
+        future = self.pool.submit(self.recognize, pcm, rate, width)
+        with self.pending_lock:
+            self.pending.append(future)
+        future.add_done_callback(self.deliver)
+
+    def deliver(self, future):
+        # Hands finished transcripts on in speaking order
+        ready = []
+        with self.pending_lock:
+            while self.pending and self.pending[0].done():
+                ready.append(self.pending.popleft())
+            for done in ready:
+                try:
+                    text = done.result()
+                except Exception as e:
+                    if self.on_error:
+                        self.on_error(e)
+                    continue
+                if text:
+                    self.on_text(text)
+
+    def close(self, wait=False):
+        self.pool.shutdown(wait=wait, cancel_futures=not wait)
 
 
 class AIAssistant:
@@ -89,71 +344,50 @@ class AIAssistant:
         self.root.configure(bg=self.bg_gradient)
         
         # Variables
-        self.listener = sr.Recognizer() if SR_AVAILABLE else None
-        self.uploaded_files = []
-        self.file_contents = {}
+        self.listener = None
+        self.voice = None
+        self.voice_stop = threading.Event()
+        self.batch_cancel = None
+        self.batch_progress = ""
         self.current_topic = "General Chat"
-        self.chat_history = {}
         self.is_listening = False
-        self.request_times = deque(maxlen=10)
+        self.ui_queue = queue.Queue()
+        # Models, history, files and request scheduling live in the engine;
+        # its events are applied to the chat display by pump_ui_queue
+        self.core = BuddyEngine(on_event=self.ui_queue.put)
+        self.ui_pump_interval = 50
+        self.ui_pump_due = None
+        self.metrics_window = None
+        self.search_window = None
+        self.ui_batch_size = 500
+        self.queue_status = None
+        self.render_window = 200
+        # Drawn slice of the current topic: messages[rendered_from:rendered_to],
+        # rendered_to None when it reaches the newest message
+        self.rendered_from = 0
+        self.rendered_to = None
         self.current_ai_model = tk.StringVar(value="gemini")
+        self.stream_var = tk.BooleanVar(value=True)
+        self.cache_var = tk.BooleanVar(value=False)
+        self.hedge_var = tk.BooleanVar(value=self.core.routing.hedge)
+        self.failover_var = tk.BooleanVar(value=self.core.routing.failover)
+        self.ai_models = self.core.ai_models
         
-        self.ai_models = {
-            "gemini": "Google Gemini",
-            "groq": "Groq Llama 3.3",
-            "huggingface": "HuggingFace Flan-T5"
-        }
-        
-        self.connection_status = {
-            "gemini": "unchecked",
-            "groq": "unchecked",
-            "huggingface": "unchecked"
-        }
+        # TTS engine is created on first use by the speech worker's thread,
+        # off the startup path
+        self.engine = None
+        self.speech = SpeechWorker(self.create_tts_engine)
+        self.tts_var = tk.BooleanVar(value=TTS_AVAILABLE)
         
-        # TTS
-        if TTS_AVAILABLE:
-            try:
-                self.engine = pyttsx3.init()
-                self.engine.setProperty("rate", 175)
-                self.tts_var = tk.BooleanVar(value=True)
-            except:
-                self.engine = None
-                self.tts_var = tk.BooleanVar(value=False)
-        else:
-            self.engine = None
-            self.tts_var = tk.BooleanVar(value=False)
-        
-        self.init_ai_clients()
         self.setup_ui()
         self.create_menu_bar()
+        self.schedule_ui_pump()
+        self.root.after_idle(self.record_startup_time)
         self.load_history()
         self.root.after(300000, self.auto_save_history)
         self.root.after(1000, self.show_startup_diagnostics)
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
-
-    def init_ai_clients(self):
-        # Gemini
-        self.gemini = None
-        self.gemini_enabled = False
-        self.gemini_api_key = "Type your api key"
-        
-        if GEMINI_AVAILABLE:
-            try:
-                self.gemini = genai.Client(api_key=self.gemini_api_key)
-                self.gemini_enabled = True
-                self.connection_status["gemini"] = "configured"
-            except Exception as e:
-                self.connection_status["gemini"] = f"error: {e}"
-        else:
-            self.connection_status["gemini"] = "library not installed"
-        
-        # Groq
-        self.groq_api_key = "Type your api key"
-        self.connection_status["groq"] = "configured"
-        
-        # HuggingFace
-        self.hf_api_key = "Type your api key"
-        self.connection_status["huggingface"] = "configured"
+        self.root.bind("<Control-f>", self.show_search)
 
     def show_startup_diagnostics(self):
         diagnostics = []
@@ -172,141 +406,177 @@ class AIAssistant:
             diagnostics.append(f"{status} {lib}")
         
         diagnostics.append("\nAI Models:")
-        for model, status in self.connection_status.items():
+        for model, status in self.core.connection_status.items():
             if status == "configured":
                 diagnostics.append(f"[OK] {self.ai_models[model]}")
             else:
                 diagnostics.append(f"[ERR] {self.ai_models[model]} - {status}")
         
+        diagnostics.append("\nProvider latency:")
+        for model, stats in self.core.provider_stats.items():
+            diagnostics.append(f"{self.ai_models[model]}: {stats.summary()}")
+        
+        cache_state = "on" if self.cache_var.get() else "off"
+        diagnostics.append(f"\nResponse cache ({cache_state}): {self.core.response_cache.stats()}")
+        
         self.add_message("system", "System Diagnostics:\n" + "\n".join(diagnostics))
 
+    def show_metrics(self):
+        if self.metrics_window is not None and self.metrics_window.winfo_exists():
+            self.metrics_window.lift()
+            return
+        window = self.metrics_window = tk.Toplevel(self.root)
+        window.title("Metrics")
+        window.geometry("900x550")
+        buttons = tk.Frame(window)
+        buttons.pack(fill=tk.X, padx=10, pady=(10, 0))
+        tk.Button(buttons, text="Export Prometheus...", relief=tk.FLAT, bg=self.primary_color, fg="white",
+                  command=lambda: self.export_metrics(".prom")).pack(side=tk.LEFT)
+        tk.Button(buttons, text="Export JSON Lines...", relief=tk.FLAT, bg=self.primary_color, fg="white",
+                  command=lambda: self.export_metrics(".jsonl")).pack(side=tk.LEFT, padx=8)
+        text = scrolledtext.ScrolledText(window, wrap=tk.NONE, font=("Consolas", 9))
+        text.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        
+        def refresh():
+            if not window.winfo_exists():
+                return
+            lines = [f"{'series':<70} {'count':>8} {'p50':>10} {'p95':>10} {'sum/value':>12}"]
+            for series, count, p50, p95, total in self.core.metrics.summary_rows():
+                cells = [f"{value:>8}" if value is not None else " " * 8 for value in [count]]
+                cells += [f"{value:>10.4g}" if value is not None else " " * 10 for value in (p50, p95)]
+                cells.append(f"{total:>12.4g}" if total is not None else "")
+                lines.append(f"{series:<70} " + " ".join(cells))
+            lines.append("\nRecent errors:")
+            for ts, source, error in list(self.core.metrics.errors)[-10:]:
+                lines.append(f"{datetime.datetime.fromtimestamp(ts):%H:%M:%S} {source}: {error}")
+            position = text.yview()[0]
+            text.config(state=tk.NORMAL)
+            text.delete("1.0", tk.END)
+            text.insert(tk.END, "\n".join(lines))
+            text.config(state=tk.DISABLED)
+            text.yview_moveto(position)
+            window.after(1000, refresh)
+        
+        refresh()
+
+    def export_metrics(self, extension):
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=extension,
+            filetypes=[("Prometheus text", "*.prom"), ("JSON lines", "*.jsonl"), ("All files", "*.*")]
+        )
+        if file_path:
+            try:
+                self.core.metrics.export(file_path)
+            except Exception as e:
+                messagebox.showerror("Error", f"Export failed: {e}")
+
     def test_api_connection(self, model):
+        if model == "compare":
+            self.test_all_connections()
+            return
         self.add_message("system", f"Testing {self.ai_models[model]}...")
         
-        def test_thread():
+        def test_job(job):
             try:
-                if model == "gemini":
-                    result = self.test_gemini_connection()
-                elif model == "groq":
-                    result = self.test_groq_connection()
-                elif model == "huggingface":
-                    result = self.test_hf_connection()
-                else:
-                    result = ("error", "Unknown model")
-                
-                status, message = result
+                status, message = self.core.test_connection(model)
                 if status == "success":
                     self.add_message("system", f"[OK] {self.ai_models[model]}: {message}")
-                    self.connection_status[model] = "working"
                 else:
                     self.add_message("system", f"[ERR] {self.ai_models[model]}: {message}")
             except Exception as e:
                 self.add_message("system", f"[ERR] Test failed: {e}")
         
-        threading.Thread(target=test_thread, daemon=True).start()
-
-    def test_gemini_connection(self):
-        if not GEMINI_AVAILABLE:
-            return ("error", "google-genai not installed")
-        try:
-            response = self.gemini.models.generate_content(
-                model="gemini-2.0-flash-exp",
-                contents="Say 'ok' only"
-            )
-            return ("success", "Connected")
-        except Exception as e:
-            return ("error", str(e)[:50])
-
-    def test_groq_connection(self):
-        try:
-            url = "https://api.groq.com/openai/v1/chat/completions"
-            headers = {
-                "Authorization": f"Bearer {self.groq_api_key}",
-                "Content-Type": "application/json"
-            }
-            data = {
-                "model": "llama-3.3-70b-versatile",
-                "messages": [{"role": "user", "content": "Say ok"}],
-                "max_tokens": 10
-            }
-            response = requests.post(url, headers=headers, json=data, timeout=15)
-            response.raise_for_status()
-            return ("success", "Connected")
-        except Exception as e:
-            return ("error", str(e)[:50])
-
-    def test_hf_connection(self):
-        try:
-            url = "https://api-inference.huggingface.co/models/google/flan-t5-large"
-            headers = {"Authorization": f"Bearer {self.hf_api_key}"}
-            data = {"inputs": "Say ok"}
-            response = requests.post(url, headers=headers, json=data, timeout=30)
-            response.raise_for_status()
-            return ("success", "Connected")
-        except Exception as e:
-            return ("error", str(e)[:50])
-
-    def read_file_content(self, file_path):
-        try:
-            file_ext = Path(file_path).suffix.lower()
-            file_size = Path(file_path).stat().st_size
-            
-            if file_size > 5 * 1024 * 1024:
-                return f"[File too large: {file_size / (1024*1024):.1f}MB]"
-            
-            if file_ext in ['.txt', '.md', '.py', '.js', '.java', '.cpp', '.json', '.csv']:
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    return f.read(50000)
-            elif file_ext == '.pdf' and PDF_AVAILABLE:
-                with open(file_path, 'rb') as f:
-                    pdf = PyPDF2.PdfReader(f)
-                    text = ""
-                    for i in range(min(5, len(pdf.pages))):
-                        text += pdf.pages[i].extract_text()
-                    return text[:50000]
-            elif file_ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']:
-                return f"[Image: {Path(file_path).name}]"
-            else:
-                return f"[File: {Path(file_path).name}]"
-        except Exception as e:
-            return f"[Error: {e}]"
+        self.core.scheduler.submit(model, test_job, kind="test")
 
     def upload_files(self):
         files = filedialog.askopenfilenames(title="Select Files")
         if files:
-            self.uploaded_files = list(files)
-            self.file_contents = {}
-            for file_path in self.uploaded_files:
-                content = self.read_file_content(file_path)
-                self.file_contents[file_path] = content
-            self.file_label.config(text=f"Files: {len(files)} attached")
-            self.add_message("file", f"Attached {len(files)} file(s)")
+            generation = self.core.start_ingest(files)
+            self.file_label.config(text=f"Reading 0/{len(files)} files...")
+            threading.Thread(target=self.ingest_files, args=(list(files), generation),
+                             daemon=True).start()
+
+    def ingest_files(self, files, generation):
+        def progress(done, total):
+            self.post_ui(self.show_ingest_progress, generation, done, total)
+        result = self.core.ingest_files(files, generation, progress)
+        if result is not None:
+            self.post_ui(self.finish_ingest, generation, *result)
+
+    def show_ingest_progress(self, generation, done, total):
+        if generation == self.core.ingest_generation and done < total:
+            self.file_label.config(text=f"Reading {done}/{total} files...")
+
+    def finish_ingest(self, generation, contents, retriever, images):
+        if self.core.finish_ingest(generation, contents, retriever, images):
+            self.file_label.config(text=f"Files: {len(contents)} attached")
+            self.add_message("file", f"Attached {len(contents)} file(s)")
+            if images:
+                original = sum(image.original_bytes for image in images)
+                sent = sum(len(image.data) for image in images)
+                self.add_message("file", f"{len(images)} image(s) for Gemini: {original / 1024:,.0f} KB "
+                                         f"sent as {sent / 1024:,.0f} KB")
 
     def show_file_preview(self):
-        if not self.file_contents:
+        if not self.core.file_contents:
             return
         preview_window = tk.Toplevel(self.root)
         preview_window.title("File Preview")
         preview_window.geometry("700x500")
         preview_text = scrolledtext.ScrolledText(preview_window, wrap=tk.WORD)
         preview_text.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
-        for file_path, content in self.file_contents.items():
+        for file_path, content in self.core.file_contents.items():
             preview_text.insert(tk.END, f"\n{'='*60}\n{Path(file_path).name}\n{'='*60}\n{content[:500]}\n")
         preview_text.config(state=tk.DISABLED)
 
     def clear_files(self):
-        self.uploaded_files = []
-        self.file_contents = {}
+        self.core.clear_files()
         self.file_label.config(text="No files")
         self.add_message("system", "Files cleared")
 
-    def get_file_context(self):
-        if not self.file_contents:
-            return ""
-        context = "\n\n=== FILES ===\n"
-        for file_path, content in self.file_contents.items():
-            context += f"\nFile: {Path(file_path).name}\n{content}\n"
-        return context + "\n=== END FILES ===\n"
+    def set_context_budget(self):
+        budget = simpledialog.askinteger("File Context Budget",
+                                         "Maximum tokens of file content per message:",
+                                         initialvalue=self.core.context_token_budget, minvalue=100)
+        if budget:
+            self.core.context_token_budget = budget
+            self.add_message("system", f"File context budget set to {budget:,} tokens")
+
+    def set_history_budget(self):
+        budget = simpledialog.askinteger("Conversation Memory Budget",
+                                         "Maximum tokens of recent conversation per message\n"
+                                         "(older turns are summarised):",
+                                         initialvalue=self.core.history_token_budget, minvalue=100)
+        if budget:
+            self.core.history_token_budget = budget
+            self.add_message("system", f"Conversation memory budget set to {budget:,} tokens")
+
+    def set_image_limits(self):
+        encoder = self.core.image_encoder
+        side = simpledialog.askinteger("Image Size Limit", "Longest side of images sent to Gemini (pixels):",
+                                       initialvalue=encoder.max_side, minvalue=256)
+        if not side:
+            return
+        size = simpledialog.askinteger("Image Size Limit", "Maximum size of each image (KB):",
+                                       initialvalue=encoder.max_bytes // 1024, minvalue=32)
+        if size:
+            encoder.max_side = side
+            encoder.max_bytes = size * 1024
+            self.add_message("system", f"Images will be sent at up to {side} px and {size:,} KB "
+                                       f"(re-attach to apply)")
+
+    def update_routing(self):
+        self.core.routing.hedge = self.hedge_var.get()
+        self.core.routing.failover = self.failover_var.get()
+
+    def set_hedge_delay(self):
+        delay = simpledialog.askfloat("Hedge Delay",
+                                      "Seconds before asking a backup model (0 = use the model's p95 latency):",
+                                      initialvalue=self.core.routing.hedge_delay or 0, minvalue=0)
+        if delay is not None:
+            self.core.routing.hedge_delay = delay or None
+            text = f"{delay:g} s" if delay else "automatic (p95 latency)"
+            self.add_message("system", f"Hedge delay set to {text}")
 
     def setup_ui(self):
         # Header
@@ -337,6 +607,8 @@ class AIAssistant:
         for key, name in self.ai_models.items():
             tk.Radiobutton(model_frame, text=name, variable=self.current_ai_model,
                           value=key, bg=self.sidebar_bg, command=self.on_model_change).pack(anchor=tk.W)
+        tk.Radiobutton(model_frame, text=COMPARE_LABEL, variable=self.current_ai_model,
+                      value="compare", bg=self.sidebar_bg, command=self.on_model_change).pack(anchor=tk.W)
         
         tk.Button(model_frame, text="Test Connection",
                  command=lambda: self.test_api_connection(self.current_ai_model.get()),
@@ -353,9 +625,8 @@ class AIAssistant:
                                          bg=self.text_bg, selectbackground=self.primary_color)
         self.topics_listbox.pack(fill=tk.BOTH, expand=True)
         
-        for topic in ["General Chat", "Programming", "Creative", "Science"]:
+        for topic in DEFAULT_TOPICS:
             self.topics_listbox.insert(tk.END, topic)
-            self.chat_history[topic] = []
         
         self.topics_listbox.select_set(0)
         self.topics_listbox.bind('<<ListboxSelect>>', self.on_topic_select)
@@ -379,13 +650,15 @@ class AIAssistant:
         self.topic_label.pack(side=tk.LEFT, fill=tk.X, expand=True)
         self.ai_indicator = tk.Label(header, text="Gemini", bg=self.text_bg, padx=16)
         self.ai_indicator.pack(side=tk.RIGHT)
+        self.queue_label = tk.Label(header, text="", bg=self.text_bg, fg="#64748b", padx=8)
+        self.queue_label.pack(side=tk.RIGHT)
         
         # Chat display
         self.chat_display = scrolledtext.ScrolledText(chat, wrap=tk.WORD, font=("Segoe UI", 10),
                                                       bg=self.text_bg, fg=self.text_fg, padx=16, pady=12,
                                                       height=15)
         self.chat_display.pack(fill=tk.BOTH, expand=True, pady=(0, 8))
-        self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.config(state=tk.DISABLED, yscrollcommand=self.on_chat_scroll)
         
         self.chat_display.tag_config("user", foreground=self.primary_color, font=("Segoe UI", 10, "bold"))
         self.chat_display.tag_config("buddy", foreground=self.secondary_color)
@@ -393,6 +666,7 @@ class AIAssistant:
         self.chat_display.tag_config("file", foreground=self.success_color)
         self.chat_display.tag_config("error", foreground=self.error_color)
         self.chat_display.tag_config("warning", foreground=self.warning_color)
+        self.chat_display.tag_config("search_hit", background="#fde68a")
         
         # Files
         file_frame = tk.Frame(chat, bg=self.text_bg)
@@ -436,37 +710,121 @@ class AIAssistant:
         menubar.add_cascade(label="File", menu=file_menu)
         file_menu.add_command(label="Clear Chat", command=self.clear_chat)
         file_menu.add_command(label="Export Chat", command=self.export_chat)
+        file_menu.add_command(label="Search History...", command=self.show_search, accelerator="Ctrl+F")
+        file_menu.add_command(label="Run Batch...", command=self.run_batch)
         file_menu.add_separator()
         file_menu.add_command(label="Exit", command=self.root.quit)
         
         settings_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Settings", menu=settings_menu)
-        settings_menu.add_checkbutton(label="Enable TTS", variable=self.tts_var)
+        settings_menu.add_checkbutton(label="Enable TTS", variable=self.tts_var, command=self.toggle_tts)
+        settings_menu.add_checkbutton(label="Stream Responses", variable=self.stream_var)
+        settings_menu.add_checkbutton(label="Cache Responses", variable=self.cache_var)
+        settings_menu.add_command(label="File Context Budget...", command=self.set_context_budget)
+        settings_menu.add_command(label="Conversation Memory Budget...", command=self.set_history_budget)
+        settings_menu.add_command(label="Image Size Limit...", command=self.set_image_limits)
+        settings_menu.add_checkbutton(label="Hedge Slow Requests", variable=self.hedge_var,
+                                      command=self.update_routing)
+        settings_menu.add_checkbutton(label="Automatic Failover", variable=self.failover_var,
+                                      command=self.update_routing)
+        settings_menu.add_command(label="Hedge Delay...", command=self.set_hedge_delay)
         settings_menu.add_command(label="Test All", command=self.test_all_connections)
+        settings_menu.add_command(label="Diagnostics", command=self.show_startup_diagnostics)
+        settings_menu.add_command(label="Metrics...", command=self.show_metrics)
         
         help_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Help", menu=help_menu)
         help_menu.add_command(label="About", command=self.show_about)
 
-    def add_message(self, sender, message):
-        self.chat_display.config(state=tk.NORMAL)
-        timestamp = datetime.datetime.now().strftime("%H:%M")
-        
+    def message_header(self, sender, timestamp):
         if sender == "user":
-            self.chat_display.insert(tk.END, f"\nYou ({timestamp})\n", "user")
+            return [f"\nYou ({timestamp})\n", "user"]
         elif sender == "buddy":
-            self.chat_display.insert(tk.END, f"\nBuddy ({timestamp})\n", "buddy")
+            return [f"\nBuddy ({timestamp})\n", "buddy"]
         elif sender in ["system", "file", "error", "warning"]:
-            self.chat_display.insert(tk.END, f"\n{sender.title()} ({timestamp})\n", sender)
-        
-        self.chat_display.insert(tk.END, f"{message}\n", sender if sender != "user" else "buddy")
+            return [f"\n{sender.title()} ({timestamp})\n", sender]
+        return []
+
+    def message_segments(self, sender, message, timestamp):
+        return self.message_header(sender, timestamp) + [
+            f"{message}\n", sender if sender != "user" else "buddy"]
+
+    # Chat display updates go through ui_queue so worker threads never touch
+    # Tk widgets; pump_ui_queue applies them on the main loop.
+    def add_message(self, sender, message):
+        return self.core.add_message(self.current_topic, sender, message)
+
+    def post_ui(self, func, *args):
+        self.ui_queue.put(("call", func, args))
+
+    def schedule_ui_pump(self):
+        self.ui_pump_due = time.perf_counter() + self.ui_pump_interval / 1000
+        self.root.after(self.ui_pump_interval, self.pump_ui_queue)
+
+    def pump_ui_queue(self):
+        # How late this tick ran is the Tk event loop's lag
+        start = time.perf_counter()
+        metrics = self.core.metrics
+        metrics.observe("buddy_ui_loop_lag_seconds", max(0.0, start - self.ui_pump_due))
+        try:
+            metrics.set("buddy_ui_queue_depth", self.ui_queue.qsize())
+            self.core.scheduler.update_metrics()
+            self.drain_ui_queue(self.ui_batch_size)
+            self.update_queue_status()
+        finally:
+            metrics.observe("buddy_ui_pump_seconds", time.perf_counter() - start)
+            self.schedule_ui_pump()
+
+    def record_startup_time(self):
+        self.core.metrics.set("buddy_startup_seconds", round(time.perf_counter() - STARTED, 4))
+
+    def drain_ui_queue(self, limit=None):
+        # Consecutive chat events are coalesced into one insert/see() call
+        segments = []
+        count = 0
+        while limit is None or count < limit:
+            try:
+                event = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            count += 1
+            kind = event[0]
+            if kind == "call":
+                self.flush_segments(segments)
+                segments = []
+                try:
+                    event[1](*event[2])
+                except Exception as e:
+                    print(f"UI update error: {e}")
+                continue
+            
+            topic, sender = event[1], event[2]
+            if topic != self.current_topic or self.rendered_to is not None:
+                continue  # an older window is shown; load_newer_messages pages it in
+            if kind == "message":
+                segments += self.message_segments(sender, event[3], event[4])
+            elif kind == "stream_begin":
+                segments += self.message_header(sender, event[3])
+            elif kind == "stream_chunk":
+                segments += [event[3], sender]
+        self.flush_segments(segments)
+
+    def update_queue_status(self):
+        status = self.core.scheduler.queue_depth() + (self.batch_progress,)
+        if status == self.queue_status:
+            return
+        self.queue_status = status
+        queued, running, batch = status
+        text = f"{running} running, {queued} queued" if queued or running else ""
+        self.queue_label.config(text=" | ".join(filter(None, [batch, text])))
+
+    def flush_segments(self, segments):
+        if not segments:
+            return
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.insert(tk.END, *segments)
         self.chat_display.see(tk.END)
         self.chat_display.config(state=tk.DISABLED)
-        
-        if self.current_topic in self.chat_history:
-            self.chat_history[self.current_topic].append({
-                "sender": sender, "message": message, "timestamp": timestamp
-            })
 
     def on_enter_key(self, event):
         if not event.state & 0x1:
@@ -479,161 +837,281 @@ class AIAssistant:
             return
         
         self.user_input.delete("1.0", tk.END)
-        self.add_message("user", user_message)
+        generation = self.speech.interrupt()
+        if self.rendered_to is not None:
+            self.switch_topic(self.current_topic)  # back to the newest messages
+        model = self.current_ai_model.get()
+        if model == "compare":
+            # compare() records the question and answers cheap ones itself
+            futures = self.core.compare(self.current_topic, user_message, self.cache_var.get())
+            if "local" in futures:
+                self.speak(futures["local"].result())
+            return
         
-        if self.handle_commands(user_message):
+        index = self.add_message("user", user_message)
+        reply = self.core.local_reply(user_message)
+        if reply is not None:
+            self.add_message("buddy", reply)
+            self.speak(reply)
             return
         
-        threading.Thread(target=self.get_ai_response, args=(user_message,), daemon=True).start()
+        self.core.scheduler.submit(model, self.get_ai_response, self.current_topic, user_message, index, model,
+                                   self.stream_var.get(), self.cache_var.get(),
+                                   generation if self.tts_var.get() else None)
 
-    def handle_commands(self, message):
-        msg = message.lower()
+    def get_ai_response(self, job, topic, user_message, message_index, model, stream, cache, speech):
+        # Runs on a scheduler worker, so the Tk settings arrive as arguments;
+        # `speech` is the speech generation taken when the message was sent
+        # (None with TTS off). Streamed text is spoken sentence by sentence
+        # as it arrives, until a newer message interrupts it.
+        streamed = []
         
-        if "time" in msg:
-            self.add_message("buddy", datetime.datetime.now().strftime("%I:%M %p"))
-            return True
-        if "date" in msg:
-            self.add_message("buddy", datetime.datetime.now().strftime("%B %d, %Y"))
-            return True
-        if "joke" in msg and JOKES_AVAILABLE:
-            self.add_message("buddy", pyjokes.get_joke())
-            return True
+        def on_event(event):
+            self.ui_queue.put(event)
+            if speech is not None and event[0] == "stream_chunk" and event[2] == "buddy" \
+                    and not job.cancelled.is_set():
+                streamed.append(True)
+                self.speech.feed(event[3], generation=speech)
         
-        return False
-
-    def get_conversation_context(self):
-        if self.current_topic not in self.chat_history:
-            return ""
-        context = self.chat_history[self.current_topic][-5:]
-        conversation = "\n".join([f"{msg['sender']}: {msg['message']}"
-                                 for msg in context if msg['sender'] in ['user', 'buddy']])
-        return f"\nConversation:\n{conversation}\n" if conversation else ""
-
-    def get_ai_response(self, user_message):
-        try:
-            model = self.current_ai_model.get()
-            file_context = self.get_file_context()
-            conversation_context = self.get_conversation_context()
-            full_message = conversation_context + file_context + "\n" + user_message
-            
-            self.add_message("system", f"Generating with {self.ai_models[model]}...")
-            
-            if model == "gemini":
-                response = self.get_gemini_response(full_message)
-            elif model == "groq":
-                response = self.get_groq_response(full_message)
-            elif model == "huggingface":
-                response = self.get_hf_response(full_message)
+        response = self.core.respond(topic, user_message, model, stream, cache, job.cancelled, on_event,
+                                     message_index=message_index)
+        if speech is not None and response and not job.cancelled.is_set():
+            if streamed:
+                self.speech.feed("", final=True, generation=speech)
             else:
-                response = "Model not available"
-            
-            self.add_message("buddy", response)
-            self.speak(response[:200])
-        except Exception as e:
-            self.add_message("error", f"Error: {str(e)[:100]}")
-
-    def get_gemini_response(self, message):
-        if not self.gemini_enabled:
-            raise Exception("Gemini not available")
-        try:
-            response = self.gemini.models.generate_content(
-                model="gemini-2.0-flash-exp",
-                contents=message
-            )
-            return response.text
-        except Exception as e:
-            raise Exception(f"Gemini: {str(e)[:50]}")
-
-    def get_groq_response(self, message):
-        try:
-            url = "https://api.groq.com/openai/v1/chat/completions"
-            headers = {
-                "Authorization": f"Bearer {self.groq_api_key}",
-                "Content-Type": "application/json"
-            }
-            data = {
-                "model": "llama-3.3-70b-versatile",
-                "messages": [
-                    {"role": "system", "content": "You are Buddy, a helpful assistant."},
-                    {"role": "user", "content": message}
-                ],
-                "temperature": 0.7,
-                "max_tokens": 2000
-            }
-            response = requests.post(url, headers=headers, json=data, timeout=30)
-            response.raise_for_status()
-            return response.json()['choices'][0]['message']['content']
-        except Exception as e:
-            raise Exception(f"Groq: {str(e)[:50]}")
-
-    def get_hf_response(self, message):
-        try:
-            url = "https://api-inference.huggingface.co/models/google/flan-t5-large"
-            headers = {"Authorization": f"Bearer {self.hf_api_key}"}
-            payload = {"inputs": f"Answer this question as Buddy assistant: {message}"}
-            response = requests.post(url, headers=headers, json=payload, timeout=60)
-            response.raise_for_status()
-            result = response.json()
-            if isinstance(result, list) and len(result) > 0:
-                return result[0].get('generated_text', 'No response')
-            return str(result)
-        except Exception as e:
-            raise Exception(f"HF: {str(e)[:50]}")
+                self.speech.speak(response, generation=speech)
 
     def listen_voice(self):
-        if not SR_AVAILABLE or self.is_listening:
+        # The Voice button toggles continuous capture: the microphone stays
+        # open and each utterance is transcribed into the input box
+        if not SR_AVAILABLE:
+            return
+        if self.is_listening:
+            self.voice_stop.set()
             return
         self.is_listening = True
-        self.voice_btn.config(text="Listening...", bg=self.error_color)
-        self.add_message("system", "Listening...")
+        self.voice_stop.clear()
+        self.voice_btn.config(text="Stop", bg=self.error_color)
+        self.add_message("system", "Listening... click Stop when done")
         
         def listen_thread():
             try:
+                voice = self.get_voice_capture()
                 with sr.Microphone() as source:
-                    self.listener.adjust_for_ambient_noise(source, duration=0.5)
-                    audio = self.listener.listen(source, timeout=5, phrase_time_limit=10)
-                text = self.listener.recognize_google(audio)
-                self.add_message("user", text)
-                self.user_input.insert("1.0", text)
+                    voice.run(source, self.voice_stop)
             except Exception as e:
                 self.add_message("warning", f"Voice error: {str(e)[:30]}")
             finally:
                 self.is_listening = False
-                self.voice_btn.config(text="Voice", bg=self.accent_color)
+                self.post_ui(self.voice_btn.config, {"text": "Voice", "bg": self.accent_color})
         
         threading.Thread(target=listen_thread, daemon=True).start()
 
+    def get_voice_capture(self):
+        # Kept for the app's lifetime, so the noise calibration happens once
+        if self.voice is None:
+            self.listener = sr.Recognizer()
+            self.voice = VoiceCapture(self.recognize_speech, lambda text: self.post_ui(self.insert_voice_text, text),
+                                      lambda e: self.add_message("warning", f"Voice error: {str(e)[:30]}"))
+        return self.voice
+
+    def recognize_speech(self, pcm, sample_rate, sample_width):
+        try:
+            return self.listener.recognize_google(sr.AudioData(pcm, sample_rate, sample_width))
+        except sr.UnknownValueError:
+            return None
+
+    def insert_voice_text(self, text):
+        if self.user_input.get("1.0", "end-1c").strip():
+            text = " " + text
+        self.user_input.insert(tk.END, text)
+        self.user_input.see(tk.END)
+
     def speak(self, text):
-        if not self.tts_var.get() or not self.engine:
-            return
-        def speak_thread():
+        if self.tts_var.get():
+            self.speech.speak(text)
+
+    def toggle_tts(self):
+        if not self.tts_var.get():
+            self.speech.interrupt()
+
+    def create_tts_engine(self):
+        # Called once, on the speech worker's thread
+        if TTS_AVAILABLE:
             try:
-                self.engine.say(text)
-                self.engine.runAndWait()
-            except:
-                pass
-        threading.Thread(target=speak_thread, daemon=True).start()
+                self.engine = pyttsx3.init()
+                self.engine.setProperty("rate", 175)
+            except Exception as e:
+                print(f"TTS unavailable: {e}")
+                self.post_ui(self.tts_var.set, False)
+        return self.engine
 
     def on_topic_select(self, event):
         selection = self.topics_listbox.curselection()
         if selection:
             self.switch_topic(self.topics_listbox.get(selection[0]))
 
-    def switch_topic(self, topic):
+    def switch_topic(self, topic, focus=None):
+        if topic != self.current_topic:
+            self.core.scheduler.cancel(kind="chat")
+        self.drain_ui_queue()
         self.current_topic = topic
         self.topic_label.config(text=topic)
+        
+        # Only the newest render_window messages are drawn, in one insert;
+        # older pages are added by load_older_messages when scrolled to the top.
+        # With focus (a message index), a render_window around that message
+        # is drawn instead, marked focus_start..focus_end, and newer pages are
+        # added by load_newer_messages when scrolled to the bottom.
+        with self.core.history_lock:
+            messages = self.core.chat_history.get(topic, [])
+            self.rendered_from = max(0, len(messages) - self.render_window)
+            self.rendered_to = None
+            if focus is not None and focus < self.rendered_from:
+                self.rendered_from = max(0, focus - self.render_window // 2)
+                self.rendered_to = self.rendered_from + self.render_window
+            parts = ([], [], [])
+            for index, msg in enumerate(messages[self.rendered_from:self.rendered_to], self.rendered_from):
+                part = 0 if focus is None or index < focus else 1 if index == focus else 2
+                parts[part].extend(self.message_segments(msg["sender"], msg["message"], msg["timestamp"]))
+        
         self.chat_display.config(state=tk.NORMAL)
         self.chat_display.delete("1.0", tk.END)
+        for segments, mark in zip(parts, ("focus_start", "focus_end", None)):
+            if segments:
+                self.chat_display.insert(tk.END, *segments)
+            if mark:
+                self.chat_display.mark_set(mark, "end-1c")
+                self.chat_display.mark_gravity(mark, tk.LEFT)
+        if focus is None:
+            self.chat_display.see(tk.END)
+        else:
+            self.chat_display.see("focus_end")
+            self.chat_display.yview("focus_start")
         self.chat_display.config(state=tk.DISABLED)
-        if topic in self.chat_history:
-            for msg in self.chat_history[topic]:
-                self.add_message(msg["sender"], msg["message"])
+
+    def on_chat_scroll(self, first, last):
+        self.chat_display.vbar.set(first, last)
+        if self.rendered_from > 0 and float(first) <= 0.0:
+            self.root.after_idle(self.load_older_messages)
+        if self.rendered_to is not None and float(last) >= 1.0:
+            self.root.after_idle(self.load_newer_messages)
+
+    def load_older_messages(self):
+        if self.rendered_from <= 0:
+            return
+        with self.core.history_lock:
+            messages = self.core.chat_history.get(self.current_topic, [])
+            end = min(self.rendered_from, len(messages))
+            start = max(0, end - self.render_window)
+            segments = []
+            for msg in messages[start:end]:
+                segments += self.message_segments(msg["sender"], msg["message"], msg["timestamp"])
+            self.rendered_from = start
+        if not segments:
+            return
+        
+        # Keep the message that was at the top in view after prepending
+        self.chat_display.mark_set("older_anchor", "1.0")
+        self.chat_display.mark_gravity("older_anchor", tk.RIGHT)
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.insert("1.0", *segments)
+        self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.yview("older_anchor")
+        self.chat_display.mark_unset("older_anchor")
+
+    def load_newer_messages(self):
+        if self.rendered_to is None:
+            return
+        with self.core.history_lock:
+            messages = self.core.chat_history.get(self.current_topic, [])
+            start = self.rendered_to
+            end = start + self.render_window
+            segments = []
+            for msg in messages[start:end]:
+                segments += self.message_segments(msg["sender"], msg["message"], msg["timestamp"])
+            self.rendered_to = end if end < len(messages) else None
+        if not segments:
+            return
+        
+        # Appending leaves the view where it is
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.insert(tk.END, *segments)
+        self.chat_display.config(state=tk.DISABLED)
+
+    def show_search(self, event=None):
+        if self.search_window is not None and self.search_window.winfo_exists():
+            self.search_window.lift()
+            self.search_window.focus_force()
+            return
+        window = self.search_window = tk.Toplevel(self.root)
+        window.title("Search History")
+        window.geometry("640x420")
+        query = tk.StringVar()
+        entry = tk.Entry(window, textvariable=query, font=("Segoe UI", 11))
+        entry.pack(fill=tk.X, padx=10, pady=(10, 0))
+        status = tk.Label(window, text="Type to search every topic", anchor=tk.W, fg="#64748b")
+        status.pack(fill=tk.X, padx=10)
+        results = tk.Listbox(window, font=("Segoe UI", 10), bg=self.text_bg, selectbackground=self.primary_color)
+        results.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+        hits = []
+        pending = []
+        
+        def run_search():
+            pending.clear()
+            start = time.perf_counter()
+            hits[:] = self.core.search(query.get())
+            elapsed = (time.perf_counter() - start) * 1000
+            results.delete(0, tk.END)
+            for hit in hits:
+                snippet = " ".join(hit["snippet"].split())
+                results.insert(tk.END, f"{hit['topic']} | {hit['timestamp']} {hit['sender']}: {snippet}")
+            status.config(text=f"{len(hits)} result(s) in {elapsed:.1f} ms" if query.get().strip() else "")
+        
+        def on_change(*args):
+            # Searches once typing pauses rather than on every keystroke
+            if pending:
+                window.after_cancel(pending.pop())
+            pending.append(window.after(120, run_search))
+        
+        def open_hit(event=None):
+            selection = results.curselection() or ((0,) if hits else ())
+            if selection:
+                hit = hits[selection[0]]
+                self.jump_to_message(hit["topic"], hit["index"], query.get())
+        
+        query.trace_add("write", on_change)
+        entry.bind("<Return>", open_hit)
+        entry.bind("<Down>", lambda event: (results.focus_set(), results.selection_set(0)))
+        results.bind("<Double-Button-1>", open_hit)
+        results.bind("<Return>", open_hit)
+        entry.focus_set()
+
+    def jump_to_message(self, topic, index, query=""):
+        topics = self.topics_listbox.get(0, tk.END)
+        if topic not in topics:
+            return
+        self.topics_listbox.selection_clear(0, tk.END)
+        self.topics_listbox.select_set(topics.index(topic))
+        self.topics_listbox.see(topics.index(topic))
+        self.switch_topic(topic, focus=index)
+        # Highlight the query's words inside the message that matched
+        count = tk.IntVar()
+        for word in set(re.findall(r"\w+", query)):
+            start = "focus_start"
+            while True:
+                start = self.chat_display.search(word, start, stopindex="focus_end", nocase=True, count=count)
+                if not start or not count.get():
+                    break
+                end = f"{start}+{count.get()}c"
+                self.chat_display.tag_add("search_hit", start, end)
+                start = end
 
     def add_new_topic(self):
         topic = simpledialog.askstring("New Topic", "Enter topic name:")
         if topic:
             self.topics_listbox.insert(tk.END, topic)
-            self.chat_history[topic] = []
+            self.core.create_topic(topic)
             self.topics_listbox.selection_clear(0, tk.END)
             self.topics_listbox.select_set(tk.END)
             self.switch_topic(topic)
@@ -643,24 +1121,28 @@ class AIAssistant:
         if not selection:
             return
         topic = self.topics_listbox.get(selection[0])
-        if topic in ["General Chat", "Programming", "Creative", "Science"]:
+        if topic in DEFAULT_TOPICS:
             messagebox.showwarning("Warning", "Cannot delete default topics")
             return
         if messagebox.askyesno("Delete Topic", f"Delete '{topic}'?"):
             self.topics_listbox.delete(selection[0])
-            if topic in self.chat_history:
-                del self.chat_history[topic]
+            self.core.delete_topic(topic)
             self.topics_listbox.select_set(0)
             self.switch_topic(self.topics_listbox.get(0))
 
     def on_model_change(self):
         model = self.current_ai_model.get()
-        self.ai_indicator.config(text=self.ai_models[model])
-        self.add_message("system", f"Switched to {self.ai_models[model]}")
+        self.core.scheduler.cancel(kind="chat")
+        name = COMPARE_LABEL if model == "compare" else self.ai_models[model]
+        self.ai_indicator.config(text=name)
+        self.add_message("system", f"Switched to {name}")
 
     def clear_chat(self):
         if messagebox.askyesno("Clear Chat", "Clear current topic chat history?"):
-            self.chat_history[self.current_topic] = []
+            self.drain_ui_queue()
+            self.core.clear_topic(self.current_topic)
+            self.rendered_from = 0
+            self.rendered_to = None
             self.chat_display.config(state=tk.NORMAL)
             self.chat_display.delete("1.0", tk.END)
             self.chat_display.config(state=tk.DISABLED)
@@ -677,17 +1159,74 @@ class AIAssistant:
                     f.write(f"Buddy AI Chat Export - {self.current_topic}\n")
                     f.write(f"Exported: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}\n")
                     f.write("="*60 + "\n\n")
-                    for msg in self.chat_history.get(self.current_topic, []):
+                    for msg in self.core.chat_history.get(self.current_topic, []):
                         f.write(f"[{msg['timestamp']}] {msg['sender'].upper()}: {msg['message']}\n\n")
                 messagebox.showinfo("Success", "Chat exported successfully!")
             except Exception as e:
                 messagebox.showerror("Error", f"Export failed: {e}")
 
+    def run_batch(self):
+        # Answers go to a JSONL file, not the chat; choosing the same output
+        # again resumes an interrupted batch
+        if self.batch_cancel is not None:
+            if messagebox.askyesno("Batch", "A batch is running. Stop it?"):
+                self.batch_cancel.set()
+            return
+        model = self.current_ai_model.get()
+        if model not in self.core.providers:
+            messagebox.showinfo("Batch", "Pick a single AI model for the batch")
+            return
+        source = filedialog.askopenfilename(title="Batch Prompts",
+                                            filetypes=[("Prompts", "*.jsonl *.csv"), ("All files", "*.*")])
+        if not source:
+            return
+        output = filedialog.asksaveasfilename(title="Save Answers", defaultextension=".jsonl",
+                                              initialfile=Path(source).stem + ".answers.jsonl",
+                                              confirmoverwrite=False)
+        if not output:
+            return
+        try:
+            items = read_batch_items(source)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Batch", f"Cannot read prompts: {e}")
+            return
+        self.batch_cancel = threading.Event()
+        self.add_message("system", f"Batch: {len(items)} prompts with {self.ai_models[model]}, "
+                                   f"answers in {Path(output).name}")
+        threading.Thread(target=self.batch_worker, args=(items, output, model, self.cache_var.get(),
+                                                         self.batch_cancel), daemon=True).start()
+
+    def batch_worker(self, items, output, model, cache, cancelled):
+        def progress(report):
+            self.post_ui(self.show_batch_progress, report)
+        try:
+            report = self.core.run_batch(items, output, model, cache, progress, cancelled)
+            self.post_ui(self.add_message, "system",
+                         f"Batch {'stopped' if report['cancelled'] else 'done'}: {report['ok']} answered, "
+                         f"{report['failed']} failed, {report['skipped']} already done in {report['seconds']:.1f} s "
+                         f"({report['prompts_per_s']:.2f} prompts/s, {report['tokens_per_s']:.0f} tokens/s)")
+        except Exception as e:
+            self.post_ui(self.add_message, "error", f"Batch failed: {str(e)[:100]}")
+        finally:
+            self.post_ui(self.finish_batch)
+
+    def show_batch_progress(self, report):
+        done = report["ok"] + report["failed"] + report["skipped"]
+        self.batch_progress = f"Batch {done}/{report['items']}, {report['prompts_per_s']:.1f}/s"
+
+    def finish_batch(self):
+        self.batch_cancel = None
+        self.batch_progress = ""
+
     def test_all_connections(self):
         self.add_message("system", "Testing all AI models...")
-        for model in self.ai_models.keys():
-            time.sleep(0.5)
-            self.test_api_connection(model)
+        
+        def report(model, result):
+            status, message = result
+            mark = "[OK]" if status == "success" else "[ERR]"
+            self.add_message("system", f"{mark} {self.ai_models[model]}: {message}")
+        
+        self.core.async_loop.submit(self.core.test_connections(list(self.ai_models), report))
 
     def show_about(self):
         about_text = """
@@ -708,21 +1247,20 @@ Created with Python & Tkinter
 
     def load_history(self):
         try:
-            if Path("chat_history.json").exists():
-                with open("chat_history.json", 'r', encoding='utf-8') as f:
-                    loaded_history = json.load(f)
-                    self.chat_history.update(loaded_history)
-                    for topic in loaded_history.keys():
-                        if topic not in [self.topics_listbox.get(i) for i in range(self.topics_listbox.size())]:
-                            self.topics_listbox.insert(tk.END, topic)
+            # Only the topic index is read here; messages load when a topic is opened
+            topics = self.core.load_history()
+            listed = set(self.topics_listbox.get(0, tk.END))
+            for topic in topics:
+                if topic not in listed:
+                    self.topics_listbox.insert(tk.END, topic)
+            if topics:
                 self.add_message("system", "Chat history loaded")
         except Exception as e:
             self.add_message("warning", f"Could not load history: {e}")
 
     def save_history(self):
         try:
-            with open("chat_history.json", 'w', encoding='utf-8') as f:
-                json.dump(self.chat_history, f, ensure_ascii=False, indent=2)
+            self.core.save_history()
         except Exception as e:
             print(f"Save error: {e}")
 
@@ -732,13 +1270,25 @@ Created with Python & Tkinter
 
     def on_closing(self):
         if messagebox.askokcancel("Quit", "Save chat history and exit?"):
-            self.save_history()
+            self.voice_stop.set()
+            if self.batch_cancel is not None:
+                self.batch_cancel.set()
+            if self.voice is not None:
+                self.voice.close()
+            self.speech.close()
+            self.core.close()
             self.root.destroy()
 
 
 def main():
     root = tk.Tk()
     app = AIAssistant(root)
+    if os.environ.get("BUDDY_STARTUP_PROBE"):
+        # Used by bench.py: report when the first frame is painted, then exit
+        root.update()
+        print(f"first_paint {time.perf_counter() - STARTED:.4f}", flush=True)
+        root.destroy()
+        return
     root.mainloop()
 
 
@@ -0,0 +1,3065 @@
+"""
+Buddy AI Assistant - headless engine
+
+Model routing, context assembly, attached files and chat history, with no
+Tk dependency. buddy.py (desktop app) and buddy_headless.py (CLI and HTTP
+API) are front ends over BuddyEngine.
+"""
+
+import ast
+import asyncio
+import bisect
+import codecs
+import contextlib
+import csv
+import datetime
+import hashlib
+import importlib
+import importlib.util
+import io
+import json
+import math
+import mmap
+import operator
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from collections import deque, OrderedDict
+from concurrent.futures import (Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait,
+                                FIRST_COMPLETED, CancelledError, TimeoutError as FutureTimeoutError)
+from pathlib import Path
+
+
+def module_available(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+class LazyModule:
+    # Stand-in that imports the real module on first attribute access, so
+    # optional heavy libraries cost nothing until a feature uses them
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# Availability is a cheap find_spec lookup; nothing is imported until used
+JOKES_AVAILABLE = module_available("pyjokes")
+pyjokes = LazyModule("pyjokes")
+
+GEMINI_AVAILABLE = module_available("google.genai")
+genai = LazyModule("google.genai")
+
+PDF_AVAILABLE = module_available("PyPDF2")
+PyPDF2 = LazyModule("PyPDF2")
+
+PIL_AVAILABLE = module_available("PIL")
+Image = LazyModule("PIL.Image")
+ImageOps = LazyModule("PIL.ImageOps")
+
+NUMPY_AVAILABLE = module_available("numpy")
+np = LazyModule("numpy")
+
+requests = LazyModule("requests")
+
+AIOHTTP_AVAILABLE = module_available("aiohttp")
+aiohttp = LazyModule("aiohttp")
+
+
+WORD_RE = re.compile(r"\w+")
+
+
+FOLLOW_UP_RE = re.compile(r"\s*(?:why|how so|and|but|also|so|then|what about|how about|tell me more|more|go on|"
+                          r"continue|elaborate|expand|same|explain (?:that|this|it|why)|what do you mean|"
+                          r"(?:can|could) you (?:elaborate|expand|explain)|(?:it|that|this|those|these|they)\b)\b",
+                          re.IGNORECASE)
+
+
+def is_follow_up(message):
+    # Short or referring messages ("why?", "and in Python?") only make sense
+    # with the conversation before them
+    return len(WORD_RE.findall(message)) <= 2 or bool(FOLLOW_UP_RE.match(message))
+
+
+def estimate_tokens(text):
+    # ~4 characters per token is close enough for budgeting English and code
+    return max(1, len(text) // 4)
+
+
+def message_tokens(record):
+    # Token estimate cached on the message record (and journaled with it)
+    tokens = record.get("tokens")
+    if tokens is None:
+        tokens = record["tokens"] = estimate_tokens(record["message"])
+    return tokens
+
+
+def condense(text, words=25):
+    parts = text.split()
+    return " ".join(parts[:words]) + (" ..." if len(parts) > words else "")
+
+
+def create_http_session(retries=3, backoff=0.5, pool_size=10):
+    # Keep-alive session with a connection pool; retries 429/5xx with backoff
+    # and honours Retry-After. Headers are passed per request, so one session
+    # can be shared by the worker threads.
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def iter_sse_data(response):
+    # Server-sent events: one "data: ..." line per event, "[DONE]" terminates
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        yield data
+
+
+def iter_groq_chunks(response):
+    for data in iter_sse_data(response):
+        content = groq_delta(data)
+        if content:
+            yield content
+
+
+def groq_delta(data):
+    choices = json.loads(data).get("choices") or [{}]
+    return choices[0].get("delta", {}).get("content")
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class AsyncLoop:
+    # One background event loop for every provider call, so async requests
+    # share a single connection pool. Worker threads hand it coroutines.
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                self.thread.start()
+        return self.loop
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.start())
+
+    def run(self, coro, cancelled=None):
+        # Blocks the calling thread until coro finishes; setting `cancelled`
+        # cancels the task and returns None
+        future = self.submit(coro)
+        while True:
+            try:
+                return future.result(timeout=0.1)
+            except FutureTimeoutError:
+                if cancelled is not None and cancelled.is_set():
+                    future.cancel()
+                    return None
+            except CancelledError:
+                return None
+
+    def close(self, cleanup=None):
+        if self.loop is None:
+            return
+        if cleanup is not None:
+            try:
+                self.submit(cleanup()).result(timeout=5)
+            except Exception as e:
+                print(f"Async cleanup error: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+
+
+class AsyncHttpClient:
+    """Shared async HTTP pool for the REST providers.
+
+    Uses aiohttp when installed; otherwise the blocking requests session is
+    run in the loop's default executor. Retries 429/5xx with backoff.
+    """
+
+    def __init__(self, retries=3, backoff=0.5, pool_size=10, sync_session=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.sync_session = sync_session
+        self.session = None
+
+    async def request(self, url, headers, payload, timeout):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+        # timeout bounds connecting and each read, not the whole (streamed) body
+        client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+        for attempt in range(self.retries + 1):
+            response = await self.session.post(url, headers=headers, json=payload, timeout=client_timeout)
+            if response.status in RETRY_STATUSES and attempt < self.retries:
+                retry_after = response.headers.get("Retry-After", "")
+                response.release()
+                delay = float(retry_after) if retry_after.isdigit() else self.backoff * 2 ** attempt
+                await asyncio.sleep(delay)
+                continue
+            if response.status >= 400:
+                response.release()
+            response.raise_for_status()
+            return response
+
+    async def post_json(self, url, headers, payload, timeout=30):
+        if not AIOHTTP_AVAILABLE:
+            def post():
+                response = self.sync_session().post(url, headers=headers, json=payload, timeout=timeout)
+                response.raise_for_status()
+                return response.json()
+            return await asyncio.get_running_loop().run_in_executor(None, post)
+        async with await self.request(url, headers, payload, timeout) as response:
+            return await response.json(content_type=None)
+
+    async def post_lines(self, url, headers, payload, timeout=30):
+        # Yields the decoded lines of a streamed response body
+        if not AIOHTTP_AVAILABLE:
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(None, lambda: self.sync_session().post(
+                url, headers=headers, json=payload, timeout=timeout, stream=True))
+            try:
+                response.raise_for_status()
+                lines = response.iter_lines(decode_unicode=True)
+                while True:
+                    line = await loop.run_in_executor(None, next, lines, None)
+                    if line is None:
+                        break
+                    yield line
+            finally:
+                response.close()
+            return
+        async with await self.request(url, headers, payload, timeout) as response:
+            async for line in response.content:
+                yield line.decode("utf-8").rstrip("\r\n")
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+async def aiter_sse_data(lines):
+    # Async counterpart of iter_sse_data over an async iterator of lines
+    async for line in lines:
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        yield data
+
+
+SYSTEM_PROMPT = "You are Buddy, a helpful assistant."
+
+
+class ChatPrompt:
+    """Role-tagged request sent to the providers.
+
+    ``system`` is the stable prefix (instructions, whole attached files and
+    the conversation summary) so provider-side prompt caching can reuse it;
+    ``turns`` are ("user" | "assistant", text) pairs, oldest first, ending
+    with the new user message.
+    """
+
+    def __init__(self, system="", turns=(), images=()):
+        self.system = system
+        self.turns = []
+        # InlineImages sent with the newest user turn (Gemini only)
+        self.images = list(images)
+        for role, text in turns:
+            self.add(role, text)
+
+    def add(self, role, text):
+        # Consecutive turns of one role (e.g. after a failed reply) are merged
+        if self.turns and self.turns[-1][0] == role:
+            self.turns[-1] = (role, self.turns[-1][1] + "\n\n" + text)
+        else:
+            self.turns.append((role, text))
+
+    def chat_messages(self):
+        # OpenAI-style messages (Groq)
+        messages = [{"role": "system", "content": self.system}] if self.system else []
+        return messages + [{"role": role, "content": text} for role, text in self.turns]
+
+    def gemini_contents(self):
+        contents = [{"role": "model" if role == "assistant" else "user", "parts": [{"text": text}]}
+                    for role, text in self.turns]
+        if self.images and contents and contents[-1]["role"] == "user":
+            contents[-1]["parts"] = [{"inline_data": {"mime_type": image.mime_type, "data": image.data}}
+                                     for image in self.images] + contents[-1]["parts"]
+        if contents and contents[0]["role"] == "model":
+            # Gemini expects the conversation to open with a user turn
+            contents.insert(0, {"role": "user", "parts": [{"text": "(continuing our conversation)"}]})
+        return contents
+
+    def flat(self):
+        # One string for text-in/text-out endpoints (HuggingFace)
+        lines = [self.system] if self.system else []
+        lines += [f"{'buddy' if role == 'assistant' else 'user'}: {text}" for role, text in self.turns[:-1]]
+        if self.turns:
+            lines.append(self.turns[-1][1])
+        return "\n".join(lines)
+
+    def cache_text(self):
+        return json.dumps([self.system, self.turns] + [image.key for image in self.images], ensure_ascii=False)
+
+
+class Provider:
+    """Common interface of the model backends; all calls are coroutines
+    taking a ChatPrompt."""
+
+    name = ""
+    supports_stream = False
+    # Whether ChatPrompt.images reach the model; other providers drop them
+    supports_images = False
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def complete(self, prompt):
+        raise NotImplementedError
+
+    async def stream(self, prompt):
+        yield await self.complete(prompt)
+
+    async def test(self):
+        try:
+            await self.ping()
+            return ("success", "Connected")
+        except Exception as e:
+            return ("error", str(e)[:50])
+
+    async def ping(self):
+        await self.complete(ChatPrompt(turns=[("user", "Say ok")]))
+
+
+class GeminiProvider(Provider):
+    name = "gemini"
+    supports_stream = True
+    supports_images = True
+    model = "gemini-2.0-flash-exp"
+
+    def client(self):
+        if not self.engine.gemini_enabled:
+            raise Exception("Gemini not available")
+        return self.engine.gemini.aio
+
+    def request(self, prompt):
+        config = {"system_instruction": prompt.system} if prompt.system else None
+        return {"model": self.model, "contents": prompt.gemini_contents(), "config": config}
+
+    async def complete(self, prompt):
+        try:
+            response = await self.client().models.generate_content(**self.request(prompt))
+            return response.text
+        except Exception as e:
+            raise Exception(f"Gemini: {str(e)[:50]}") from e
+
+    async def stream(self, prompt):
+        try:
+            async for chunk in await self.client().models.generate_content_stream(**self.request(prompt)):
+                if chunk.text:
+                    yield chunk.text
+        except Exception as e:
+            raise Exception(f"Gemini: {str(e)[:50]}") from e
+
+    async def test(self):
+        if not GEMINI_AVAILABLE:
+            return ("error", "google-genai not installed")
+        return await super().test()
+
+    async def ping(self):
+        await self.client().models.generate_content(model=self.model, contents="Say 'ok' only")
+
+
+class GroqProvider(Provider):
+    name = "groq"
+    supports_stream = True
+    model = "llama-3.3-70b-versatile"
+
+    def __init__(self, engine, url=None):
+        super().__init__(engine)
+        self.url = url
+
+    def headers(self):
+        return {
+            "Authorization": f"Bearer {self.engine.groq_api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def payload(self, prompt, stream=False):
+        data = {
+            "model": self.model,
+            "messages": prompt.chat_messages(),
+            "temperature": 0.7,
+            "max_tokens": 2000
+        }
+        if stream:
+            data["stream"] = True
+        return data
+
+    async def complete(self, prompt):
+        try:
+            result = await self.engine.http.post_json(self.url or self.engine.groq_url, self.headers(),
+                                                      self.payload(prompt), timeout=30)
+            return result['choices'][0]['message']['content']
+        except Exception as e:
+            raise Exception(f"Groq: {str(e)[:50]}") from e
+
+    async def stream(self, prompt):
+        try:
+            lines = self.engine.http.post_lines(self.url or self.engine.groq_url, self.headers(),
+                                                self.payload(prompt, stream=True), timeout=30)
+            async for data in aiter_sse_data(lines):
+                content = groq_delta(data)
+                if content:
+                    yield content
+        except Exception as e:
+            raise Exception(f"Groq: {str(e)[:50]}") from e
+
+    async def ping(self):
+        data = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": "Say ok"}],
+            "max_tokens": 10
+        }
+        await self.engine.http.post_json(self.url or self.engine.groq_url, self.headers(), data, timeout=15)
+
+
+class HuggingFaceProvider(Provider):
+    name = "huggingface"
+
+    def headers(self):
+        return {"Authorization": f"Bearer {self.engine.hf_api_key}"}
+
+    async def complete(self, prompt):
+        try:
+            payload = {"inputs": f"Answer this question as Buddy assistant: {prompt.flat()}"}
+            result = await self.engine.http.post_json(self.engine.hf_url, self.headers(), payload, timeout=60)
+            if isinstance(result, list) and len(result) > 0:
+                return result[0].get('generated_text', 'No response')
+            return str(result)
+        except Exception as e:
+            raise Exception(f"HF: {str(e)[:50]}") from e
+
+    async def ping(self):
+        await self.engine.http.post_json(self.engine.hf_url, self.headers(), {"inputs": "Say ok"}, timeout=30)
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144)
+
+
+class Histogram:
+    # Cumulative bucket counts for export plus recent samples for quantiles
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=1000)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q):
+        samples = sorted(self.recent)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+class Metrics:
+    """In-process metrics: histograms, counters and gauges keyed by name and
+    labels, exportable as Prometheus text or JSON lines. Thread-safe."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.errors = deque(maxlen=50)
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def record_error(self, source, error):
+        # Full error text; what the chat shows is cut short
+        self.inc("buddy_errors_total", source=source)
+        with self.lock:
+            self.errors.append((time.time(), source, error))
+
+    def summary_rows(self):
+        # (name{labels}, count, p50, p95, total) for display, then counters and gauges
+        rows = []
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                rows.append((self.series(name, labels), histogram.count, histogram.quantile(0.5),
+                             histogram.quantile(0.95), histogram.sum))
+            for (name, labels), value in sorted(self.counters.items()):
+                rows.append((self.series(name, labels), value, None, None, None))
+            for (name, labels), value in sorted(self.gauges.items()):
+                rows.append((self.series(name, labels), None, None, None, value))
+        return rows
+
+    @staticmethod
+    def series(name, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return name
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                   for _, value in pairs)
+        return name + "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + "}"
+
+    def prometheus(self):
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                declare(name, "histogram")
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{self.series(name + '_bucket', labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.series(name + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{self.series(name + '_count', labels)} {histogram.count}")
+            for (name, labels), value in sorted(self.counters.items()):
+                declare(name, "counter")
+                lines.append(f"{self.series(name, labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                declare(name, "gauge")
+                lines.append(f"{self.series(name, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def json_lines(self):
+        # One JSON object per series, stamped with the export time
+        now = time.time()
+        records = []
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                records.append({"ts": now, "name": name, "type": "histogram", "labels": dict(labels),
+                                "count": histogram.count, "sum": histogram.sum,
+                                "p50": histogram.quantile(0.5), "p95": histogram.quantile(0.95),
+                                "buckets": dict(zip(map(str, list(histogram.buckets) + ["+Inf"]),
+                                                    histogram.counts))})
+            for (name, labels), value in sorted(self.counters.items()):
+                records.append({"ts": now, "name": name, "type": "counter", "labels": dict(labels), "value": value})
+            for (name, labels), value in sorted(self.gauges.items()):
+                records.append({"ts": now, "name": name, "type": "gauge", "labels": dict(labels), "value": value})
+            for ts, source, error in self.errors:
+                records.append({"ts": ts, "name": "buddy_error", "type": "event", "labels": {"source": source},
+                                "value": error})
+        return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+    def export(self, path):
+        # .jsonl appends a snapshot (so repeated exports form a time series);
+        # anything else is overwritten with Prometheus text
+        path = Path(path)
+        if path.suffix in (".jsonl", ".json"):
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(self.json_lines())
+        else:
+            tmp = path.with_suffix(path.suffix + ".tmp")
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(self.prometheus())
+            os.replace(tmp, path)
+
+
+class ProviderStats:
+    # Rolling latency (per call kind: "complete" or first chunk of a "stream")
+    # and error rate over a provider's most recent real calls
+    def __init__(self, window=100):
+        self.latencies = {"complete": deque(maxlen=window), "stream": deque(maxlen=window)}
+        self.outcomes = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, kind, latency, ok):
+        with self.lock:
+            self.outcomes.append(ok)
+            if ok:
+                self.latencies[kind].append(latency)
+
+    def percentile(self, kind, p):
+        with self.lock:
+            samples = sorted(self.latencies[kind])
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def error_rate(self):
+        with self.lock:
+            if not self.outcomes:
+                return 0.0
+            return self.outcomes.count(False) / len(self.outcomes)
+
+    def calls(self):
+        with self.lock:
+            return len(self.outcomes)
+
+    def summary(self):
+        parts = []
+        for kind in ("complete", "stream"):
+            p50, p95 = self.percentile(kind, 50), self.percentile(kind, 95)
+            if p50 is not None:
+                parts.append(f"{kind} p50 {p50 * 1000:.0f} ms / p95 {p95 * 1000:.0f} ms")
+        parts.append(f"errors {self.error_rate():.0%} of {self.calls()}")
+        return ", ".join(parts)
+
+
+class RoutingPolicy:
+    """Picks which providers may answer a request and when to hedge.
+
+    A backup is started when the first provider has not answered after the
+    hedge delay (its rolling p95, or `hedge_delay` when set) or as soon as it
+    fails. Providers without an API key, or whose recent error rate is above
+    `max_error_rate`, are only used as a last resort. A prompt with images is
+    only handed to backups that accept images.
+    """
+
+    def __init__(self, engine, hedge=True, failover=True, hedge_delay=None, default_delay=3.0,
+                 min_delay=0.5, max_parallel=2, max_error_rate=0.5, min_calls=5):
+        self.engine = engine
+        self.hedge = hedge
+        self.failover = failover
+        self.hedge_delay = hedge_delay
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_parallel = max_parallel
+        self.max_error_rate = max_error_rate
+        self.min_calls = min_calls
+
+    def healthy(self, model):
+        stats = self.engine.provider_stats[model]
+        return stats.calls() < self.min_calls or stats.error_rate() <= self.max_error_rate
+
+    def candidates(self, model, images=False):
+        # The chosen model first (unless it is failing), then configured
+        # backups fastest first
+        if not (self.hedge or self.failover):
+            return [model]
+        backups = [other for other in self.engine.ai_models
+                   if other != model and self.engine.provider_configured(other) and self.healthy(other)
+                   and (not images or self.engine.providers[other].supports_images)]
+        backups.sort(key=lambda other: self.engine.provider_stats[other].percentile("complete", 50) or math.inf)
+        if backups and not self.healthy(model):
+            return backups + [model]
+        return [model] + backups
+
+    def delay(self, model, kind):
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        p95 = self.engine.provider_stats[model].percentile(kind, 95)
+        return max(self.min_delay, p95) if p95 is not None else self.default_delay
+
+
+class TokenBucket:
+    # Client-side rate limiter: `rate` requests per second, bursts up to `capacity`
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # Tokens taken in the last minute, for recent(); at most rate * 60 + capacity
+        self.request_times = deque()
+        self.lock = threading.Lock()
+
+    def take(self):
+        # Takes a token if one is available; returns 0, or the seconds to wait
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.request_times.append(now)
+                self.expire(now)
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def recent(self):
+        # Requests let through in the last minute
+        with self.lock:
+            self.expire(time.monotonic())
+            return len(self.request_times)
+
+    def expire(self, now):
+        while self.request_times and now - self.request_times[0] > 60:
+            self.request_times.popleft()
+
+    def acquire(self, cancelled=None):
+        while True:
+            wait = self.take()
+            if not wait:
+                return True
+            if cancelled is None:
+                time.sleep(wait)
+            elif cancelled.wait(wait):
+                return False
+
+
+class RequestJob:
+    def __init__(self, provider, kind, fn, args, cancelled=None):
+        self.provider = provider
+        self.kind = kind
+        self.fn = fn
+        self.args = args
+        self.cancelled = cancelled or threading.Event()
+        self.future = Future()
+        self.submitted = time.perf_counter()
+
+
+class RequestScheduler:
+    # Bounded worker pool with per-provider concurrency limits and token buckets.
+    # Jobs wait in per-provider queues until their provider has a free slot, so
+    # a slow provider cannot tie up every worker thread.
+    def __init__(self, max_workers, limits, rates, default_limit=2, metrics=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="buddy-ai")
+        self.metrics = metrics
+        self.limits = limits
+        self.default_limit = default_limit
+        self.buckets = {provider: TokenBucket(*rate) for provider, rate in rates.items()}
+        self.waiting = {}
+        self.running = {}
+        self.active = set()
+        self.lock = threading.Lock()
+
+    def submit(self, provider, fn, *args, kind="chat", cancelled=None):
+        job = RequestJob(provider, kind, fn, args, cancelled)
+        with self.lock:
+            self.waiting.setdefault(provider, deque()).append(job)
+        self.dispatch(provider)
+        return job
+
+    def dispatch(self, provider):
+        with self.lock:
+            waiting = self.waiting.get(provider)
+            limit = self.limits.get(provider, self.default_limit)
+            while waiting and self.running.get(provider, 0) < limit:
+                job = waiting.popleft()
+                if job.cancelled.is_set():
+                    job.future.set_result(None)
+                    continue
+                self.running[provider] = self.running.get(provider, 0) + 1
+                self.active.add(job)
+                self.executor.submit(self.run_job, job)
+
+    def run_job(self, job):
+        # job.future resolves to the job's return value, or None if cancelled
+        try:
+            result = None
+            bucket = self.buckets.get(job.provider)
+            if bucket is None or bucket.acquire(job.cancelled):
+                if not job.cancelled.is_set():
+                    if self.metrics:
+                        # Time spent queued for a slot and a rate-limit token
+                        self.metrics.observe("buddy_queue_wait_seconds", time.perf_counter() - job.submitted,
+                                             provider=job.provider, kind=job.kind)
+                    result = job.fn(job, *job.args)
+            job.future.set_result(result)
+        except Exception as e:
+            job.future.set_exception(e)
+        finally:
+            with self.lock:
+                self.running[job.provider] -= 1
+                self.active.discard(job)
+            self.dispatch(job.provider)
+
+    def reserve(self, provider):
+        # Takes a provider slot and a rate-limit token without queueing, for
+        # calls started outside the pool (hedge backups). Returns False when
+        # either is unavailable; a True must be paired with release().
+        with self.lock:
+            if self.running.get(provider, 0) >= self.limits.get(provider, self.default_limit):
+                return False
+            bucket = self.buckets.get(provider)
+            if bucket is not None and bucket.take():
+                return False
+            self.running[provider] = self.running.get(provider, 0) + 1
+            return True
+
+    def release(self, provider):
+        with self.lock:
+            self.running[provider] -= 1
+        self.dispatch(provider)
+
+    def cancel(self, kind=None):
+        with self.lock:
+            for job in self.active:
+                if kind is None or job.kind == kind:
+                    job.cancelled.set()
+            for provider, waiting in self.waiting.items():
+                kept = deque()
+                for job in waiting:
+                    if kind is None or job.kind == kind:
+                        job.cancelled.set()
+                        job.future.set_result(None)
+                    else:
+                        kept.append(job)
+                self.waiting[provider] = kept
+
+    def queue_depth(self):
+        with self.lock:
+            queued = sum(1 for waiting in self.waiting.values() for job in waiting
+                         if not job.cancelled.is_set())
+            return queued, len(self.active)
+
+    def update_metrics(self):
+        # Queue depth and each provider's requests in the last minute, as gauges
+        if self.metrics is None:
+            return
+        queued, running = self.queue_depth()
+        self.metrics.set("buddy_scheduler_jobs", queued, state="queued")
+        self.metrics.set("buddy_scheduler_jobs", running, state="running")
+        for provider, bucket in self.buckets.items():
+            self.metrics.set("buddy_requests_last_minute", bucket.recent(), provider=provider)
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class HeldStream:
+    # A response stream that holds a scheduler slot until it is closed
+    def __init__(self, stream, scheduler, provider):
+        self.stream = stream
+        self.scheduler = scheduler
+        self.provider = provider
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.stream.__anext__()
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.release(self.provider)
+                self.scheduler = None
+
+
+class ResponseCache:
+    # In-memory LRU with TTL in front of the model calls, optionally backed by
+    # an SQLite file so answers survive restarts
+    def __init__(self, max_entries=256, ttl=24 * 3600, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            try:
+                self.db = sqlite3.connect(path, check_same_thread=False)
+                self.db.execute("CREATE TABLE IF NOT EXISTS responses "
+                                "(key TEXT PRIMARY KEY, response TEXT, created REAL)")
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"Response cache disabled on disk: {e}")
+                self.db = None
+
+    @staticmethod
+    def make_key(model, prompt):
+        return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None and self.db is not None:
+                row = self.db.execute("SELECT created, response FROM responses WHERE key = ?",
+                                      (key,)).fetchone()
+                if row and now - row[0] <= self.ttl:
+                    entry = row
+                    self.store(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, response):
+        now = time.time()
+        with self.lock:
+            self.store(key, (now, response))
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                                (key, response, now))
+                self.db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+                self.db.commit()
+
+    def store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            rate = self.hits / total * 100 if total else 0.0
+            return f"{self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), {len(self.entries)} entries"
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+
+SEARCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, topic TEXT, position INTEGER,
+                                     sender TEXT, timestamp TEXT, message TEXT);
+CREATE INDEX IF NOT EXISTS messages_topic ON messages (topic, position);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(message, content='messages', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS messages_added AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_removed AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+END;
+CREATE TABLE IF NOT EXISTS indexed (topic TEXT PRIMARY KEY, file TEXT, inode INTEGER, size INTEGER,
+                                    count INTEGER);
+"""
+
+
+class SearchIndex:
+    # Full-text index over every topic's messages (SQLite FTS5, BM25 ranked).
+    # The history journal's writer thread keeps it in step with the topic
+    # files; `indexed` records how far into each file it has read, so only
+    # new lines are indexed. Queries use their own connection and never
+    # wait for a write (WAL).
+    #
+    # BM25 has to score every matching row, which for a common word is most
+    # of the history, so only the newest `candidates` matches are ranked.
+    def __init__(self, path, candidates=2000):
+        self.candidates = candidates
+        self.lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.db = None
+        try:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SEARCH_SCHEMA)
+            self.reader = sqlite3.connect(path, check_same_thread=False)
+        except sqlite3.Error as e:
+            print(f"Search index disabled: {e}")
+            self.db = None
+
+    def state(self, topic):
+        # (file, inode, size, count) as of the last update, or None
+        with self.lock:
+            return self.db.execute("SELECT file, inode, size, count FROM indexed WHERE topic = ?",
+                                   (topic,)).fetchone()
+
+    def indexed_topics(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT topic FROM indexed")]
+
+    def update(self, topic, file, inode, size, count, rows, reset=False):
+        # rows: (position, sender, timestamp, message); reset drops the
+        # topic's old rows first (the file was rewritten or cleared)
+        with self.lock, self.db:
+            if reset:
+                self.db.execute("DELETE FROM messages WHERE topic = ?", (topic,))
+            self.db.executemany("INSERT INTO messages (topic, position, sender, timestamp, message) "
+                                "VALUES (?, ?, ?, ?, ?)", ((topic, *row) for row in rows))
+            self.db.execute("INSERT OR REPLACE INTO indexed VALUES (?, ?, ?, ?, ?)",
+                            (topic, file, inode, size, count))
+
+    def drop(self, topic):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM messages WHERE topic = ?", (topic,))
+            self.db.execute("DELETE FROM indexed WHERE topic = ?", (topic,))
+
+    @staticmethod
+    def match_query(text):
+        # Every word must appear; the last one is a prefix while it is
+        # still being typed. Quoting keeps FTS5 syntax out of user input.
+        words = re.findall(r"\w+", text.lower())
+        if not words:
+            return None
+        terms = [f'"{word}"' for word in words]
+        if not text[-1:].isspace():
+            terms[-1] += "*"
+        return " ".join(terms)
+
+    def search(self, text, topic=None, limit=50):
+        # Best matches first: dicts with the topic, the message's position in
+        # it, sender, timestamp and a snippet with the hits in [brackets]
+        query = self.match_query(text)
+        if self.db is None or query is None:
+            return []
+        where = "messages_fts MATCH ?" + (" AND m.topic = ?" if topic is not None else "")
+        params = [query] + ([topic] if topic is not None else [])
+        join = "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+        with self.read_lock:
+            oldest = self.reader.execute(
+                f"SELECT min(id) FROM (SELECT messages_fts.rowid AS id {join} WHERE {where} "
+                f"ORDER BY messages_fts.rowid DESC LIMIT ?)", params + [self.candidates]).fetchone()[0]
+            if oldest is None:
+                return []
+            rows = self.reader.execute(
+                f"SELECT m.topic, m.position, m.sender, m.timestamp, "
+                f"snippet(messages_fts, 0, '[', ']', '...', 12), bm25(messages_fts) {join} "
+                f"WHERE {where} AND messages_fts.rowid >= ? ORDER BY rank LIMIT ?",
+                params + [oldest, limit]).fetchall()
+        return [{"topic": row[0], "index": row[1], "sender": row[2], "timestamp": row[3],
+                 "snippet": row[4], "score": -row[5]} for row in rows]
+
+    def close(self):
+        if self.db is not None:
+            with self.lock, self.read_lock:
+                self.reader.close()
+                self.db.close()
+            self.db = None
+
+
+class HistoryJournal:
+    # Append-only chat history: one JSONL file per topic plus a small topic
+    # index. Each message is one appended line; clearing a topic appends a
+    # marker and compact() later rewrites the file without the dead records.
+    # A topic's rolling conversation summary is stored in the same file as
+    # {"op": "summary", ...} records; the last one wins. Superseded summaries
+    # are only compacted away once they are compact_ratio of the file, so a
+    # summary update never forces a rewrite of a long topic.
+    #
+    # Appends never touch the disk on the caller's thread: lines are queued
+    # per dirty topic and a writer thread writes each burst in one go, so the
+    # UI thread never waits for disk I/O. Rewrites go through a temp file and
+    # os.replace, so a crash leaves either the old file or the new one. The
+    # writer also keeps the optional search index up to date.
+    def __init__(self, directory="chat_history", metrics=None, coalesce_delay=0.25, index=None,
+                 compact_ratio=0.25):
+        self.directory = Path(directory)
+        self.metrics = metrics
+        self.index = index if index is not None and index.db is not None else None
+        self.coalesce_delay = coalesce_delay
+        self.compact_ratio = compact_ratio
+        self.index_path = self.directory / "topics.json"
+        self.files = {}
+        self.summaries = {}
+        self.handles = {}
+        self.stale = set()
+        # Records written per topic and how many of them are dead, as far as
+        # this session has seen
+        self.records = {}
+        self.dead = {}
+        self.lock = threading.RLock()
+        self.directory.mkdir(exist_ok=True)
+        if self.index_path.exists():
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.files = json.load(f)
+        # Writer state, guarded by `changed`: topic -> queued lines, and the
+        # sync requests (a counter, so callers can wait for theirs)
+        self.changed = threading.Condition()
+        self.pending = {}
+        self.sync_requested = 0
+        self.sync_done = 0
+        self.closing = False
+        self.writer = threading.Thread(target=self.write_loop, name="buddy-history", daemon=True)
+        self.writer.start()
+
+    def topics(self):
+        with self.lock:
+            return list(self.files)
+
+    def topic_path(self, topic):
+        return self.directory / self.files[topic]
+
+    def ensure_topic(self, topic):
+        with self.lock:
+            if topic not in self.files:
+                self.files[topic] = hashlib.sha1(topic.encode("utf-8")).hexdigest()[:16] + ".jsonl"
+                self.write_index()
+
+    def write_index(self):
+        tmp = self.index_path.with_suffix(".tmp")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.files, f, ensure_ascii=False)
+        os.replace(tmp, self.index_path)
+
+    def open_handle(self, topic):
+        handle = self.handles.get(topic)
+        if handle is None:
+            path = self.topic_path(topic)
+            # Terminate a line torn by a crash so the next record stays parseable
+            torn = False
+            if path.exists() and path.stat().st_size:
+                with open(path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    torn = f.read(1) != b"\n"
+            handle = self.handles[topic] = open(path, 'a', encoding='utf-8')
+            if torn:
+                handle.write("\n")
+        return handle
+
+    def append(self, topic, record):
+        # Serialised now, so later changes to `record` are not written
+        if topic not in self.files:
+            self.ensure_topic(topic)
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.changed:
+            self.pending.setdefault(topic, []).append(line)
+            self.changed.notify()
+
+    def write_loop(self):
+        if self.index is not None:
+            self.index_all()
+        while True:
+            with self.changed:
+                while not (self.pending or self.sync_requested > self.sync_done or self.closing):
+                    self.changed.wait()
+                if not self.closing:
+                    # Let a burst of changes build up and write it as one batch
+                    self.changed.wait(self.coalesce_delay)
+                sync = self.sync_requested
+                closing = self.closing
+            try:
+                self.write_pending()
+                if sync > self.sync_done:
+                    self.sync()
+            except Exception as e:
+                print(f"History write error: {e}")
+            with self.changed:
+                self.sync_done = max(self.sync_done, sync)
+                self.changed.notify_all()
+                if closing and not self.pending:
+                    return
+
+    def write_pending(self, topic=None):
+        # Writes the queued lines of one topic, or of every dirty topic
+        with self.lock:
+            with self.changed:
+                if topic is None:
+                    batch, self.pending = self.pending, {}
+                else:
+                    batch = {topic: self.pending.pop(topic)} if topic in self.pending else {}
+            if not batch:
+                return
+            start = time.perf_counter()
+            records = 0
+            for name, lines in batch.items():
+                if name not in self.files:
+                    continue  # deleted while its lines were queued
+                handle = self.open_handle(name)
+                handle.write("".join(lines))
+                handle.flush()
+                records += len(lines)
+                self.records[name] = self.records.get(name, 0) + len(lines)
+                self.index_topic(name)
+            if self.metrics:
+                self.metrics.observe("buddy_history_write_seconds", time.perf_counter() - start)
+                self.metrics.observe("buddy_history_write_records", records, SIZE_BUCKETS)
+
+    def index_all(self):
+        # Catches the search index up with every topic file, e.g. history
+        # written before the index existed, and forgets deleted topics
+        with self.lock:
+            topics = list(self.files)
+        for topic in topics:
+            with self.lock:
+                self.index_topic(topic)
+        for topic in set(self.index.indexed_topics()) - set(topics):
+            self.index.drop(topic)
+
+    def index_topic(self, topic):
+        # Indexes the lines appended since the last call, or the whole file
+        # if it was rewritten (compacted) in the meantime. Caller holds the lock.
+        if self.index is None or topic not in self.files:
+            return
+        path = self.topic_path(topic)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return
+        state = self.index.state(topic)
+        reset = state is None or tuple(state[:2]) != (self.files[topic], stat.st_ino) or state[2] > stat.st_size
+        offset, count = (0, 0) if reset else state[2:]
+        if offset == stat.st_size and not reset:
+            return
+        rows = []
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # torn or still being written; picked up next time
+                    offset += len(line)
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get("op") == "clear":
+                        rows, count, reset = [], 0, True
+                    elif "op" not in record:
+                        rows.append((count, record.get("sender"), record.get("timestamp"), record.get("message", "")))
+                        count += 1
+            self.index.update(topic, self.files[topic], stat.st_ino, offset, count, rows, reset)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Search index error: {e}")
+
+    def request_sync(self, wait=False):
+        # Asks the writer to fsync and compact; with wait, blocks until done
+        with self.changed:
+            self.sync_requested += 1
+            ticket = self.sync_requested
+            self.changed.notify_all()
+            if wait:
+                while self.sync_done < ticket and self.writer.is_alive():
+                    self.changed.wait(1)
+
+    def sync(self):
+        start = time.perf_counter()
+        self.flush()
+        self.compact()
+        if self.metrics:
+            self.metrics.observe("buddy_history_save_seconds", time.perf_counter() - start)
+
+    def load_topic(self, topic):
+        start = time.perf_counter()
+        messages = self.read_topic(topic)
+        if self.metrics:
+            self.metrics.observe("buddy_history_load_seconds", time.perf_counter() - start)
+            self.metrics.observe("buddy_history_load_messages", len(messages), SIZE_BUCKETS)
+        return messages
+
+    def read_topic(self, topic):
+        messages = []
+        with self.lock:
+            if topic not in self.files:
+                return messages
+            self.write_pending(topic)
+            path = self.topic_path(topic)
+            if not path.exists():
+                return messages
+            lines = 0
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get("op") == "clear":
+                        self.stale.add(topic)
+                        self.summaries.pop(topic, None)
+                        messages = []
+                    elif record.get("op") == "summary":
+                        self.summaries[topic] = {"text": record["text"], "covered": record["covered"]}
+                    else:
+                        messages.append(record)
+            self.records[topic] = lines
+            self.dead[topic] = lines - len(messages) - (topic in self.summaries)
+        return messages
+
+    def clear_topic(self, topic):
+        with self.lock:
+            self.append(topic, {"op": "clear"})
+            self.summaries.pop(topic, None)
+            self.stale.add(topic)
+
+    def summary(self, topic):
+        # Only known once the topic has been loaded
+        with self.lock:
+            return self.summaries.get(topic)
+
+    def set_summary(self, topic, text, covered):
+        # The previous summary record becomes dead weight for compact()
+        with self.lock:
+            if topic in self.summaries:
+                self.dead[topic] = self.dead.get(topic, 0) + 1
+            self.summaries[topic] = {"text": text, "covered": covered}
+            self.append(topic, {"op": "summary", "text": text, "covered": covered})
+
+    def close_handle(self, topic):
+        handle = self.handles.pop(topic, None)
+        if handle is not None:
+            handle.close()
+
+    def delete_topic(self, topic):
+        with self.lock:
+            with self.changed:
+                self.pending.pop(topic, None)
+            self.close_handle(topic)
+            self.stale.discard(topic)
+            self.summaries.pop(topic, None)
+            self.records.pop(topic, None)
+            self.dead.pop(topic, None)
+            name = self.files.pop(topic, None)
+            if name:
+                (self.directory / name).unlink(missing_ok=True)
+                self.write_index()
+            if self.index is not None:
+                self.index.drop(topic)
+
+    def compact(self):
+        # Rewrites cleared topics, and topics whose dead records have reached
+        # compact_ratio of the file
+        with self.lock:
+            wasteful = {topic for topic, dead in self.dead.items()
+                        if dead and dead >= self.compact_ratio * self.records.get(topic, 0)}
+            for topic in self.stale | wasteful:
+                self.stale.discard(topic)
+                if topic not in self.files:
+                    continue
+                messages = self.load_topic(topic)
+                self.stale.discard(topic)
+                self.close_handle(topic)
+                path = self.topic_path(topic)
+                tmp = path.with_suffix(".tmp")
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    for record in messages:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    summary = self.summaries.get(topic)
+                    if summary:
+                        f.write(json.dumps(dict(op="summary", **summary), ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, path)
+                self.records[topic] = len(messages) + bool(summary)
+                self.dead[topic] = 0
+                self.index_topic(topic)
+
+    def import_legacy(self, history):
+        with self.lock:
+            self.write_pending()
+            for topic, messages in history.items():
+                self.ensure_topic(topic)
+                handle = self.open_handle(topic)
+                for record in messages:
+                    handle.write(json.dumps(record, ensure_ascii=False) + "\n")
+                handle.flush()
+                self.index_topic(topic)
+
+    def flush(self):
+        with self.lock:
+            self.write_pending()
+            for handle in self.handles.values():
+                handle.flush()
+                os.fsync(handle.fileno())
+
+    def close(self):
+        # Drains the queue, syncs and compacts, then stops the writer
+        with self.changed:
+            self.closing = True
+            self.changed.notify_all()
+        self.writer.join()
+        with self.lock:
+            self.sync()
+            for topic in list(self.handles):
+                self.close_handle(topic)
+
+
+class LazyHistory(dict):
+    # topic -> message list; topics known from the journal hold None until
+    # they are first accessed
+    def __init__(self, journal):
+        super().__init__()
+        self.journal = journal
+
+    def __getitem__(self, topic):
+        messages = super().__getitem__(topic)
+        if messages is None:
+            messages = self.journal.load_topic(topic)
+            super().__setitem__(topic, messages)
+        return messages
+
+    def get(self, topic, default=None):
+        return self[topic] if topic in self else default
+
+    def add_unloaded(self, topic):
+        if not super().get(topic):
+            super().__setitem__(topic, None)
+
+
+TEXT_EXTENSIONS = ['.txt', '.md', '.py', '.js', '.java', '.cpp', '.json', '.csv']
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']
+
+
+PREVIEW_CHARS = 50000
+
+
+def iter_file_text(file_path, block_size=1 << 20):
+    # Yields extracted text in bounded blocks so files of any size can be
+    # processed without holding them in memory
+    file_ext = Path(file_path).suffix.lower()
+    if file_ext in TEXT_EXTENSIONS:
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+                for start in range(0, len(data), block_size):
+                    yield decoder.decode(data[start:start + block_size])
+                yield decoder.decode(b"", final=True)
+    elif file_ext == '.pdf' and PDF_AVAILABLE:
+        with open(file_path, 'rb') as f:
+            pdf = PyPDF2.PdfReader(f)
+            for page in pdf.pages:
+                yield (page.extract_text() or "") + "\n"
+    elif file_ext in IMAGE_EXTENSIONS:
+        yield f"[Image: {Path(file_path).name}]"
+    else:
+        yield f"[File: {Path(file_path).name}]"
+
+
+def extract_file_text(file_path, limit=PREVIEW_CHARS):
+    try:
+        parts = []
+        size = 0
+        for block in iter_file_text(file_path):
+            parts.append(block[:limit - size])
+            size += len(parts[-1])
+            if size >= limit:
+                break
+        return "".join(parts)
+    except Exception as e:
+        return f"[Error: {e}]"
+
+
+def extract_to_cache(file_path, cache_path, preview_chars=PREVIEW_CHARS):
+    # Module level so it can run in a ProcessPoolExecutor worker. Streams the
+    # full text into cache_path and returns only the leading preview.
+    tmp = cache_path + ".tmp"
+    preview = []
+    size = 0
+    with open(tmp, 'w', encoding='utf-8') as out:
+        try:
+            for block in iter_file_text(file_path):
+                out.write(block)
+                if size < preview_chars:
+                    preview.append(block[:preview_chars - size])
+                    size += len(preview[-1])
+        except Exception as e:
+            out.seek(0)
+            out.truncate()
+            preview = [f"[Error: {e}]"]
+            out.write(preview[0])
+    os.replace(tmp, cache_path)
+    return "".join(preview)
+
+
+class FileTextCache:
+    # Extracted text on disk, keyed by (absolute path, size, mtime), so
+    # re-attaching an unchanged file skips parsing entirely
+    def __init__(self, directory="file_cache", max_bytes=1024 ** 3):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(exist_ok=True)
+
+    def path_for(self, file_path):
+        try:
+            stat = Path(file_path).stat()
+        except OSError:
+            return None
+        key = f"{Path(file_path).resolve()}|{stat.st_size}|{stat.st_mtime_ns}"
+        return self.directory / (hashlib.sha256(key.encode("utf-8")).hexdigest() + ".txt")
+
+    def get(self, file_path):
+        # (cache path, preview) for a cached file, None on a miss
+        path = self.path_for(file_path)
+        if path is None or not path.exists():
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                preview = f.read(PREVIEW_CHARS)
+            os.utime(path)
+        except OSError:
+            return None
+        if preview.startswith("[Error:"):
+            return None
+        return path, preview
+
+    def prune(self):
+        # Drop least recently used entries once the cache outgrows max_bytes
+        entries = sorted(self.directory.glob("*.txt"), key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in entries)
+        for path in entries:
+            if total <= self.max_bytes:
+                break
+            total -= path.stat().st_size
+            path.unlink(missing_ok=True)
+
+
+class InlineImage:
+    # An attached image as sent to the model
+    def __init__(self, name, mime_type, data, key, original_bytes):
+        self.name = name
+        self.mime_type = mime_type
+        self.data = data
+        self.key = key
+        self.original_bytes = original_bytes
+
+
+class ImageEncoder:
+    # Downscales and recompresses attached images to at most max_side pixels
+    # and max_bytes. Results are stored on disk under the content hash and
+    # the settings, so sending the same screenshot again is a file read.
+    MIME_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}
+
+    def __init__(self, directory="image_cache", max_side=1568, max_bytes=400 * 1024, qualities=(85, 75, 60),
+                 max_raw_bytes=4 * 1024 ** 2, cache_bytes=256 * 1024 ** 2):
+        self.directory = Path(directory)
+        self.max_side = max_side
+        self.max_bytes = max_bytes
+        self.qualities = qualities
+        self.max_raw_bytes = max_raw_bytes  # without PIL, larger files are not sent
+        self.cache_bytes = cache_bytes
+        self.directory.mkdir(exist_ok=True)
+        # (path, size, mtime) -> content hash, so unchanged files are not re-read
+        self.digests = {}
+        self.lock = threading.Lock()
+
+    def digest(self, file_path):
+        stat = Path(file_path).stat()
+        stamp = (str(Path(file_path).resolve()), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            digest = self.digests.get(stamp)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(block)
+            digest = sha.hexdigest()
+            with self.lock:
+                self.digests[stamp] = digest
+        return digest, stat.st_size
+
+    def encode(self, file_path):
+        # Returns (InlineImage, from_cache), or (None, False) if the image
+        # cannot be sent
+        name = Path(file_path).name
+        digest, size = self.digest(file_path)
+        key = f"{digest[:32]}-{self.max_side}-{self.max_bytes}" if PIL_AVAILABLE else digest[:32]
+        for cached in self.directory.glob(key + ".*"):
+            mime_type = self.MIME_TYPES.get(cached.suffix)
+            if mime_type:
+                try:
+                    data = cached.read_bytes()
+                    os.utime(cached)
+                    return InlineImage(name, mime_type, data, key, size), True
+                except OSError:
+                    break
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        if PIL_AVAILABLE:
+            suffix, data = self.compress(data)
+        else:
+            suffix = Path(file_path).suffix.lower()
+            if suffix not in self.MIME_TYPES or size > self.max_raw_bytes:
+                return None, False
+        path = self.directory / (key + suffix)
+        temp = path.with_suffix(".tmp")
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+        return InlineImage(name, self.MIME_TYPES[suffix], data, key, size), False
+
+    def compress(self, data):
+        # (suffix, bytes): the original when it already fits, otherwise the
+        # image downscaled to max_side, kept lossless for screenshots and
+        # diagrams when that fits max_bytes, else a JPEG shrunk until it fits
+        with Image.open(io.BytesIO(data)) as image:
+            if image.format in ("PNG", "JPEG", "WEBP") and max(image.size) <= self.max_side \
+                    and len(data) <= self.max_bytes:
+                return "." + image.format.lower().replace("jpeg", "jpg"), data
+            lossless = image.format in ("PNG", "GIF", "BMP")
+            # JPEGs decode straight to a reduced scale
+            image.draft("RGB", (self.max_side, self.max_side))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+            if lossless:
+                # Full colour, then a 256-colour palette, which suits UI captures
+                for candidate in (image, image.convert("RGB").quantize(256)):
+                    out = io.BytesIO()
+                    candidate.save(out, "PNG")
+                    if out.tell() <= self.max_bytes:
+                        return ".png", out.getvalue()
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+            while True:
+                for quality in self.qualities:
+                    out = io.BytesIO()
+                    image.save(out, "JPEG", quality=quality, optimize=True)
+                    if out.tell() <= self.max_bytes:
+                        return ".jpg", out.getvalue()
+                if max(image.size) <= 256:
+                    return ".jpg", out.getvalue()
+                image.thumbnail((int(max(image.size) * 0.75),) * 2, Image.LANCZOS)
+
+    def prune(self):
+        entries = sorted((p for p in self.directory.iterdir() if p.suffix in self.MIME_TYPES),
+                         key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in entries)
+        for path in entries:
+            if total <= self.cache_bytes:
+                break
+            total -= path.stat().st_size
+            path.unlink(missing_ok=True)
+
+
+class PostingSegment:
+    # One run of postings sorted by term hash, as three columns (term hashes,
+    # chunk ids, term frequencies): in a file read on demand, or in memory
+    # for the last partial buffer. Every FENCE-th term hash is kept in
+    # memory to find a term's run with two small reads.
+    FENCE = 1024
+
+    def __init__(self, columns, count, path=None):
+        self.count = count
+        self.fence = array("I", memoryview(columns[0]).cast("I")[::self.FENCE])
+        self.blob = None
+        self.file = None
+        if path is None:
+            self.blob = b"".join(columns)
+        else:
+            with open(path, 'wb') as f:
+                for column in columns:
+                    f.write(column)
+            self.file = open(path, 'rb')
+            self.lock = threading.Lock()
+
+    def read(self, column, start, stop, typecode):
+        size = 2 if typecode == "H" else 4
+        begin = 4 * column * self.count + start * size
+        if self.blob is not None:
+            data = self.blob[begin:begin + (stop - start) * size]
+        else:
+            with self.lock:
+                self.file.seek(begin)
+                data = self.file.read((stop - start) * size)
+        values = array(typecode)
+        values.frombytes(data)
+        return values
+
+    def lookup(self, key):
+        # (chunk ids, term frequencies) for a term hash, or None
+        first = bisect.bisect_left(self.fence, key)
+        last = bisect.bisect_right(self.fence, key, first)
+        if last == 0:
+            return None
+        block = max(first - 1, 0) * self.FENCE
+        lo = block + bisect.bisect_left(self.read(0, block, min(self.count, block + self.FENCE), "I"), key)
+        block = (last - 1) * self.FENCE
+        hi = block + bisect.bisect_right(self.read(0, block, min(self.count, block + self.FENCE), "I"), key)
+        if hi <= lo:
+            return None
+        return self.read(1, lo, hi, "I"), self.read(2, lo, hi, "H")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class FileRetriever:
+    # Splits extracted files into overlapping chunks and ranks them with BM25
+    # so only the chunks relevant to a question go into the prompt. Chunk text
+    # stays on disk and is read back only for the chunks that are selected.
+    # Postings are (term hash, chunk, tf) rows collected in a fixed-size
+    # buffer; a full buffer is sorted by term and spilled to a segment file.
+    # Memory is then the buffer plus ~20 bytes per chunk (1500 bytes of
+    # text), however large the files are.
+    def __init__(self, chunk_bytes=1500, overlap=200, k1=1.5, b=0.75, buffer_postings=1 << 19):
+        self.chunk_bytes = chunk_bytes
+        self.overlap = overlap
+        self.k1 = k1
+        self.b = b
+        self.buffer_postings = buffer_postings
+        # Segments before the directory, so files close before it is removed
+        self.segments = []
+        self.directory = None
+        self.clear()
+
+    def clear(self):
+        self.close_segments()
+        self.names = []
+        self.sources = []
+        # Per chunk: document, byte offset, byte length and word count
+        self.chunk_docs = array("I")
+        self.chunk_starts = array("Q")
+        self.chunk_lengths = array("I")
+        self.doc_lengths = array("I")
+        self.reset_buffer()
+        self.total_tokens = 0
+
+    def reset_buffer(self):
+        self.buffer_terms = array("I")
+        self.buffer_ids = array("I")
+        self.buffer_tfs = array("H")
+
+    def close_segments(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+        if self.directory is not None:
+            self.directory.cleanup()
+            self.directory = None
+
+    def __len__(self):
+        return len(self.chunk_lengths)
+
+    def build(self, documents):
+        # documents: (name, source) pairs, source being an extracted text
+        # file or, for error placeholders, the text itself as bytes
+        self.clear()
+        for name, source in documents:
+            self.add_document(name, source)
+        self.spill(to_disk=False)
+
+    def open_source(self, source):
+        return io.BytesIO(source) if isinstance(source, bytes) else open(source, 'rb')
+
+    def add_document(self, name, source):
+        doc_id = len(self.sources)
+        self.names.append(name)
+        self.sources.append(source)
+        with self.open_source(source) as f:
+            pos = 0
+            while True:
+                # One extra byte tells whether the chunk ends mid-character
+                f.seek(pos)
+                data = f.read(self.chunk_bytes + 1)
+                if not data:
+                    break
+                skip = 0
+                while skip < len(data) and data[skip] & 0xC0 == 0x80:
+                    skip += 1
+                end = min(len(data), self.chunk_bytes)
+                while skip < end < len(data) and data[end] & 0xC0 == 0x80:
+                    end -= 1
+                self.add_chunk(doc_id, pos + skip, data[skip:end])
+                if len(data) <= self.chunk_bytes:
+                    break
+                pos += max(end - self.overlap, 1)
+            self.total_tokens += max(1, f.seek(0, os.SEEK_END) // 4)
+
+    def read_chunk(self, chunk_id):
+        start, length = self.chunk_starts[chunk_id], self.chunk_lengths[chunk_id]
+        with self.open_source(self.sources[self.chunk_docs[chunk_id]]) as f:
+            f.seek(start)
+            return f.read(length).decode('utf-8', errors='ignore')
+
+    def documents(self):
+        for name, source in zip(self.names, self.sources):
+            with self.open_source(source) as f:
+                yield name, f.read().decode('utf-8', errors='ignore')
+
+    @staticmethod
+    def term_hash(word):
+        return zlib.crc32(word.encode("utf-8"))
+
+    def add_chunk(self, doc_id, start, data):
+        chunk_id = len(self.chunk_lengths)
+        self.chunk_docs.append(doc_id)
+        self.chunk_starts.append(start)
+        self.chunk_lengths.append(len(data))
+        counts = {}
+        words = WORD_RE.findall(data.decode('utf-8', errors='ignore').lower())
+        for word in words:
+            counts[word] = counts.get(word, 0) + 1
+        for word, count in counts.items():
+            self.buffer_terms.append(self.term_hash(word))
+            self.buffer_ids.append(chunk_id)
+            self.buffer_tfs.append(min(count, 0xFFFF))
+        self.doc_lengths.append(len(words))
+        if len(self.buffer_terms) >= self.buffer_postings:
+            self.spill(to_disk=True)
+
+    def spill(self, to_disk):
+        # Sorts the buffered postings by term into a new segment: a file, or
+        # memory for the last, partial buffer
+        n = len(self.buffer_terms)
+        if not n:
+            return
+        if NUMPY_AVAILABLE:
+            terms = np.frombuffer(self.buffer_terms, dtype=np.uint32)
+            order = np.argsort(terms, kind="stable")
+            columns = [np.frombuffer(column, dtype=dtype)[order].tobytes() for column, dtype in
+                       ((self.buffer_terms, np.uint32), (self.buffer_ids, np.uint32), (self.buffer_tfs, np.uint16))]
+            del terms, order
+        else:
+            order = sorted(range(n), key=self.buffer_terms.__getitem__)
+            columns = [array(column.typecode, (column[i] for i in order)).tobytes()
+                       for column in (self.buffer_terms, self.buffer_ids, self.buffer_tfs)]
+            del order
+        self.reset_buffer()
+        path = None
+        if to_disk:
+            if self.directory is None:
+                self.directory = tempfile.TemporaryDirectory(prefix="buddy-index-")
+            path = os.path.join(self.directory.name, f"segment{len(self.segments)}")
+        self.segments.append(PostingSegment(columns, n, path))
+
+    def postings(self, term):
+        # [(chunk ids, term frequencies)], one pair per segment holding the term
+        key = self.term_hash(term)
+        return [found for found in (segment.lookup(key) for segment in self.segments) if found]
+
+    def score(self, query):
+        n = len(self.chunk_lengths)
+        terms = set(WORD_RE.findall(query.lower()))
+        if NUMPY_AVAILABLE:
+            scores = np.zeros(n)
+            lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32).astype(np.float64)
+            avgdl = (lengths.mean() if n else 0) or 1.0
+            for term in terms:
+                found = self.postings(term)
+                if not found:
+                    continue
+                ids = np.concatenate([np.frombuffer(ids, dtype=np.uint32) for ids, tfs in found]).astype(np.int64)
+                tfs = np.concatenate([np.frombuffer(tfs, dtype=np.uint16) for ids, tfs in found]).astype(np.float64)
+                idf = math.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * lengths[ids] / avgdl)
+                np.add.at(scores, ids, idf * tfs * (self.k1 + 1) / (tfs + norm))
+            return scores.tolist()
+        
+        scores = [0.0] * n
+        avgdl = (sum(self.doc_lengths) / n if n else 0) or 1.0
+        for term in terms:
+            found = self.postings(term)
+            df = sum(len(ids) for ids, tfs in found)
+            if not df:
+                continue
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for ids, tfs in found:
+                for chunk_id, tf in zip(ids, tfs):
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[chunk_id] / avgdl)
+                    scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def select(self, query, token_budget):
+        # Best chunks that fit the budget, returned in document order
+        scores = self.score(query)
+        ranked = sorted(range(len(self.chunk_lengths)), key=lambda i: scores[i], reverse=True)
+        selected = []
+        used = 0
+        for chunk_id in ranked:
+            tokens = max(1, self.chunk_lengths[chunk_id] // 4)
+            if used + tokens > token_budget:
+                continue
+            selected.append(chunk_id)
+            used += tokens
+        selected.sort()
+        return [(self.names[self.chunk_docs[i]], self.read_chunk(i)) for i in selected], used
+
+
+ARITHMETIC_OPERATORS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow,
+    ast.USub: operator.neg, ast.UAdd: operator.pos,
+}
+MATH_FUNCTIONS = {
+    "sqrt": math.sqrt, "sin": math.sin, "cos": math.cos, "tan": math.tan, "log": math.log10,
+    "ln": math.log, "exp": math.exp, "abs": abs, "round": round, "floor": math.floor, "ceil": math.ceil,
+}
+MATH_CONSTANTS = {"pi": math.pi, "e": math.e}
+
+
+THOUSANDS_RE = re.compile(r"\b\d{1,3}(?:,\d{3})+\b")
+
+
+def evaluate_expression(text):
+    # Arithmetic only: numbers, + - * / // % ** (or ^, x, ×, ÷), brackets and
+    # the MATH_FUNCTIONS; anything else raises ValueError. The only commas
+    # understood are thousands separators outside function calls: "1,5" or
+    # "round(3.14159,2)" are left to the model rather than misread.
+    text = re.sub(r"(?<=[\d)])\s*[x×]\s*(?=[\d(])", "*", text.replace("÷", "/").replace("^", "**"))
+    if "," in text:
+        if re.search(r"[a-z_]\w*\s*\(", text, re.IGNORECASE):
+            raise ValueError("comma in a function call")
+        text = THOUSANDS_RE.sub(lambda match: match.group().replace(",", ""), text)
+        if "," in text:
+            raise ValueError("comma is not a thousands separator")
+    try:
+        tree = ast.parse(text, mode="eval")
+    except SyntaxError as e:
+        raise ValueError(str(e)) from e
+
+    def walk(node):
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return node.value
+        if isinstance(node, ast.Name) and node.id in MATH_CONSTANTS:
+            return MATH_CONSTANTS[node.id]
+        if isinstance(node, ast.UnaryOp) and type(node.op) in ARITHMETIC_OPERATORS:
+            return ARITHMETIC_OPERATORS[type(node.op)](walk(node.operand))
+        if isinstance(node, ast.BinOp) and type(node.op) in ARITHMETIC_OPERATORS:
+            left, right = walk(node.left), walk(node.right)
+            # Keep 9**9**9 and friends from running for minutes
+            if isinstance(node.op, ast.Pow) and (abs(right) > 1000 or abs(left) > 1e6 and abs(right) > 100):
+                raise ValueError("exponent too large")
+            return ARITHMETIC_OPERATORS[type(node.op)](left, right)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in MATH_FUNCTIONS \
+                and not node.keywords:
+            return MATH_FUNCTIONS[node.func.id](*[walk(arg) for arg in node.args])
+        raise ValueError(f"unsupported expression: {type(node).__name__}")
+
+    return walk(tree.body)
+
+
+def format_number(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        value = int(value)
+    if isinstance(value, int):
+        return f"{value:,}" if abs(value) < 10 ** 30 else f"{value:.6e}"
+    return f"{value:,.10g}" if abs(value) < 1e15 else f"{value:.6e}"
+
+
+# (dimension, factor, offset, names): value * factor + offset gives the
+# dimension's base unit
+UNIT_TABLE = [
+    ("length", 1, 0, "m meter meters metre metres"),
+    ("length", 1000, 0, "km kilometer kilometers kilometre kilometres"),
+    ("length", 0.01, 0, "cm centimeter centimeters centimetre centimetres"),
+    ("length", 0.001, 0, "mm millimeter millimeters millimetre millimetres"),
+    ("length", 1609.344, 0, "mi mile miles"),
+    ("length", 0.9144, 0, "yd yard yards"),
+    ("length", 0.3048, 0, "ft foot feet"),
+    ("length", 0.0254, 0, "inch inches"),
+    ("mass", 1, 0, "kg kilogram kilograms kilo kilos"),
+    ("mass", 0.001, 0, "g gram grams"),
+    ("mass", 0.45359237, 0, "lb lbs pound pounds"),
+    ("mass", 0.028349523125, 0, "oz ounce ounces"),
+    ("volume", 1, 0, "l liter liters litre litres"),
+    ("volume", 0.001, 0, "ml milliliter milliliters millilitre millilitres"),
+    ("volume", 3.785411784, 0, "gal gallon gallons"),
+    ("volume", 0.2365882365, 0, "cup cups"),
+    ("time", 1, 0, "s sec secs second seconds"),
+    ("time", 60, 0, "min mins minute minutes"),
+    ("time", 3600, 0, "h hr hrs hour hours"),
+    ("time", 86400, 0, "day days"),
+    ("time", 604800, 0, "week weeks"),
+    ("temperature", 1, 273.15, "c °c celsius"),
+    ("temperature", 5 / 9, 273.15 - 32 * 5 / 9, "f °f fahrenheit"),
+    ("temperature", 1, 0, "k kelvin"),
+    ("data", 1, 0, "b byte bytes"),
+    ("data", 1000, 0, "kb kilobyte kilobytes"),
+    ("data", 1000 ** 2, 0, "mb megabyte megabytes"),
+    ("data", 1000 ** 3, 0, "gb gigabyte gigabytes"),
+    ("data", 1000 ** 4, 0, "tb terabyte terabytes"),
+    ("data", 1024, 0, "kib"),
+    ("data", 1024 ** 2, 0, "mib"),
+    ("data", 1024 ** 3, 0, "gib"),
+    ("speed", 1, 0, "m/s"),
+    ("speed", 1000 / 3600, 0, "km/h kph kmh"),
+    ("speed", 1609.344 / 3600, 0, "mph"),
+]
+UNITS = {name: (dimension, factor, offset)
+         for dimension, factor, offset, names in UNIT_TABLE for name in names.split()}
+UNIT_PATTERN = "(?:" + "|".join(re.escape(name) for name in sorted(UNITS, key=len, reverse=True)) + ")"
+NUMBER_PATTERN = r"-?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?"
+
+
+def convert_units(amount, source, target):
+    # None when the units measure different things
+    source_dimension, source_factor, source_offset = UNITS[source]
+    target_dimension, target_factor, target_offset = UNITS[target]
+    if source_dimension != target_dimension:
+        return None
+    return (amount * source_factor + source_offset - target_offset) / target_factor
+
+
+def reply_time(match):
+    return datetime.datetime.now().strftime("%I:%M %p")
+
+
+def reply_date(match):
+    return datetime.datetime.now().strftime("%B %d, %Y")
+
+
+def reply_joke(match):
+    return pyjokes.get_joke() if JOKES_AVAILABLE else None
+
+
+NOT_ARITHMETIC = re.compile(r"\d+(?:-\d+)+|\d{1,2}/\d{1,2}/\d{2,4}")
+
+
+def reply_arithmetic(match):
+    expression = match.group("expression").strip()
+    # A bare number is an answer to something, not a sum; unless asked to
+    # calculate, "2020-2021" or "3/4/2025" are ranges and dates
+    if not re.search(r"[-+*/^%x×÷]|[a-z]\(", expression.lstrip("-")):
+        return None
+    if not match.group("asked") and NOT_ARITHMETIC.fullmatch(expression):
+        return None
+    try:
+        return f"{expression} = {format_number(evaluate_expression(expression))}"
+    except ZeroDivisionError:
+        return f"{expression} is undefined (division by zero)"
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+def reply_percent(match):
+    rate = float(match.group("rate").replace(",", ""))
+    whole = float(match.group("whole").replace(",", ""))
+    return f"{format_number(rate)}% of {format_number(whole)} = {format_number(rate * whole / 100)}"
+
+
+def reply_conversion(match):
+    groups = match.groupdict()
+    amount = groups["amount"] or groups["amount_asked"]
+    source = groups["source"] or groups["source_asked"]
+    target = groups["target"] or groups["target_asked"]
+    result = convert_units(float(amount.replace(",", "")), source, target)
+    if result is None:
+        return None
+    return f"{amount} {source} = {format_number(round(result, 6))} {target}"
+
+
+# (name, pattern, handler): patterns must match the whole message once
+# normalised by IntentRouter; handlers get the match and return the reply,
+# or None to leave the message to the model. Group names must be unique
+# across the table and differ from the intent names.
+BUILTIN_INTENTS = [
+    ("time", r"(?:what(?:'?s| is) the |the |current |tell me the )?time(?: is it)?(?: now| right now)?"
+             r"|what time is it(?: now| right now)?", reply_time),
+    ("date", r"(?:what(?:'?s| is) |tell me )?(?:the |today's )?date(?: today)?"
+             r"|what(?:'?s| is) (?:the date )?today|what day is (?:it|today)(?: today)?", reply_date),
+    ("joke", r"(?:tell me |say |got )?(?:a |another |any )?(?:joke|funny joke|something funny)s?"
+             r"|make me laugh", reply_joke),
+    ("percent", r"(?:what(?:'?s| is) )?(?P<rate>" + NUMBER_PATTERN + r") ?% of (?P<whole>"
+                + NUMBER_PATTERN + ")", reply_percent),
+    ("convert", r"(?:convert |what(?:'?s| is) )?(?P<amount>" + NUMBER_PATTERN + r") ?(?P<source>" + UNIT_PATTERN
+                + r") (?:to|in|into|as) (?P<target>" + UNIT_PATTERN + ")"
+                r"|how many (?P<target_asked>" + UNIT_PATTERN + r") (?:are |is )?(?:there )?in (?P<amount_asked>"
+                + NUMBER_PATTERN + r") ?(?P<source_asked>" + UNIT_PATTERN + ")", reply_conversion),
+    ("arithmetic", r"(?P<asked>what(?:'?s| is) |calculate |compute |evaluate |solve )?"
+                   r"(?P<expression>(?:[\d.,\s()+\-*/^%x×÷]|sqrt|sin|cos|tan|log|ln|exp|abs|round|floor|ceil|pi|e)+?)"
+                   r"(?: ?=)?", reply_arithmetic),
+]
+
+
+class IntentRouter:
+    # Answers cheap requests (time, date, jokes, sums, unit conversions)
+    # locally. Every intent is compiled into one regex that must match the
+    # whole message, so "sometimes" or "update my resume" never hit the
+    # time/date handlers and routing a message costs a few microseconds.
+    # Politeness around the request: "hey buddy, ...", "... please?"
+    PREFIX = r"(?:(?:hey |hi |ok |okay )?buddy\b[,!]? *|please |(?:can|could) you (?:please )?(?:tell me )?)*"
+    SUFFIX = r"(?:,? (?:please|buddy|for me))*"
+
+    def __init__(self, intents=BUILTIN_INTENTS, max_chars=160):
+        self.max_chars = max_chars
+        self.intents = []
+        self.handlers = {}
+        self.pattern = None
+        for name, pattern, handler in intents:
+            self.add(name, pattern, handler)
+
+    def add(self, name, pattern, handler):
+        # Earlier intents win when two match the same message
+        self.intents = [intent for intent in self.intents if intent[0] != name] + [(name, pattern, handler)]
+        self.handlers = {name: handler for name, pattern, handler in self.intents}
+        alternatives = "|".join(f"(?P<{name}>{pattern})" for name, pattern, handler in self.intents)
+        self.pattern = re.compile(f"{self.PREFIX}(?:{alternatives}){self.SUFFIX}")
+
+    def normalize(self, message):
+        return " ".join(message.lower().replace("\u2019", "'").split()).rstrip("?!. ")
+
+    def route(self, message):
+        # (intent name, reply), or None for messages the model should answer
+        if len(message) > self.max_chars:
+            return None
+        match = self.pattern.fullmatch(self.normalize(message))
+        if match is None:
+            return None
+        reply = self.handlers[match.lastgroup](match)
+        return None if reply is None else (match.lastgroup, reply)
+
+
+def read_batch_items(path):
+    # Prompts from JSONL (an object per line with "prompt" and optional "id",
+    # "model" and "file", or a bare string) or from CSV with a header row
+    # naming the same columns. Items without an id are numbered from 1.
+    if Path(path).suffix.lower() == ".csv":
+        with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+            rows = list(csv.DictReader(f))
+    else:
+        rows = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"{path} line {number}: {e}") from e
+                rows.append({"prompt": row} if isinstance(row, str) else row)
+    items = []
+    for index, row in enumerate(rows, 1):
+        prompt = str(row.get("prompt") or "").strip()
+        if not prompt:
+            raise ValueError(f"{path}: item {index} has no prompt")
+        items.append({"id": str(row.get("id") or index), "prompt": prompt,
+                      "model": row.get("model") or None, "file": row.get("file") or None})
+    ids = [item["id"] for item in items]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"{path}: item ids are not unique")
+    return items
+
+
+def batch_item_key(item, model):
+    # Identifies what was asked, so an edited prompt is asked again on resume
+    text = f"{model}\0{item['prompt']}\0{item.get('file') or ''}"
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+DEFAULT_TOPICS = ["General Chat", "Programming", "Creative", "Science"]
+
+API_KEY_PLACEHOLDER = "Type your api key"
+
+AI_MODELS = {
+    "gemini": "Google Gemini",
+    "groq": "Groq Llama 3.3",
+    "huggingface": "HuggingFace Flan-T5"
+}
+
+
+class BuddyEngine:
+    """Everything behind the chat window: providers, scheduling, files and history.
+
+    Output is reported as events passed to ``on_event`` (or a per-call
+    override): ("message", topic, sender, message, timestamp),
+    ("stream_begin", topic, sender, timestamp) and
+    ("stream_chunk", topic, sender, chunk).
+    """
+
+    def __init__(self, data_dir=".", on_event=None):
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.on_event = on_event
+        self.metrics = Metrics()
+        self.intents = IntentRouter()
+        
+        self.uploaded_files = []
+        self.file_contents = {}
+        self.file_retriever = FileRetriever()
+        self.file_text_cache = FileTextCache(self.data_dir / "file_cache")
+        # Attached images go to Gemini inline, downscaled to these limits
+        self.image_encoder = ImageEncoder(self.data_dir / "image_cache")
+        self.file_images = []
+        self.ingest_pool = None
+        self.ingest_generation = 0
+        self.context_token_budget = 4000
+        self.model_token_limits = {"huggingface": 400}
+        # Conversation memory: recent turns up to history_token_budget, older
+        # turns folded into a rolling summary once summary_batch_tokens of
+        # them have fallen out of the window
+        self.history_token_budget = 1500
+        self.summary_token_budget = 300
+        self.summary_batch_tokens = 600
+        self.summarizing = set()
+        self.history_lock = threading.RLock()
+        self.search_index = SearchIndex(str(self.data_dir / "search.db"))
+        self.history_journal = HistoryJournal(self.data_dir / "chat_history", self.metrics,
+                                              index=self.search_index)
+        self.chat_history = LazyHistory(self.history_journal)
+        for topic in DEFAULT_TOPICS:
+            self.chat_history[topic] = []
+        self.response_cache = ResponseCache(max_entries=256, ttl=24 * 3600,
+                                            path=str(self.data_dir / "response_cache.db"))
+        
+        self.ai_models = dict(AI_MODELS)
+        self.connection_status = {model: "unchecked" for model in self.ai_models}
+        
+        # Request scheduling: worker pool size, concurrent requests per
+        # provider and (requests per second, burst) token buckets
+        self.scheduler = RequestScheduler(
+            max_workers=8,
+            limits={"gemini": 2, "groq": 4, "huggingface": 2},
+            rates={"gemini": (10 / 60, 5), "groq": (30 / 60, 10), "huggingface": (1.0, 5)},
+            metrics=self.metrics,
+        )
+        
+        self.init_ai_clients()
+
+    def init_ai_clients(self):
+        # HTTP connection pools, one per REST provider, created on first request
+        self.http_retries = 3
+        self.http_backoff = 0.5
+        self.http_pool_size = 10
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        
+        # Gemini (the client is built by the gemini property on first request)
+        self._gemini = None
+        self.gemini_lock = threading.Lock()
+        self.gemini_enabled = GEMINI_AVAILABLE
+        self.gemini_api_key = os.environ.get("GEMINI_API_KEY", API_KEY_PLACEHOLDER)
+        
+        if GEMINI_AVAILABLE:
+            self.connection_status["gemini"] = "configured"
+        else:
+            self.connection_status["gemini"] = "library not installed"
+        
+        # Groq
+        self.groq_api_key = os.environ.get("GROQ_API_KEY", API_KEY_PLACEHOLDER)
+        self.groq_url = "https://api.groq.com/openai/v1/chat/completions"
+        self.connection_status["groq"] = "configured"
+        
+        # HuggingFace
+        self.hf_api_key = os.environ.get("HF_API_KEY", API_KEY_PLACEHOLDER)
+        self.hf_url = "https://api-inference.huggingface.co/models/google/flan-t5-large"
+        self.connection_status["huggingface"] = "configured"
+        
+        # Provider backends are coroutines on one shared event loop and HTTP pool
+        self.async_loop = AsyncLoop()
+        self.http = AsyncHttpClient(self.http_retries, self.http_backoff, self.http_pool_size,
+                                    sync_session=lambda: self.get_session("http"))
+        self.providers = {
+            "gemini": GeminiProvider(self),
+            "groq": GroqProvider(self),
+            "huggingface": HuggingFaceProvider(self),
+        }
+        # Latency/error history from real calls drives hedging and failover
+        self.provider_stats = {model: ProviderStats() for model in self.ai_models}
+        self.routing = RoutingPolicy(self)
+
+    def provider_configured(self, model):
+        if model == "gemini" and not self.gemini_enabled:
+            return False
+        key = {"gemini": self.gemini_api_key, "groq": self.groq_api_key, "huggingface": self.hf_api_key}.get(model)
+        return bool(key) and key != API_KEY_PLACEHOLDER
+
+    def get_session(self, provider):
+        with self.sessions_lock:
+            if provider not in self.sessions:
+                self.sessions[provider] = create_http_session(
+                    self.http_retries, self.http_backoff, self.http_pool_size)
+            return self.sessions[provider]
+
+    @property
+    def gemini(self):
+        if self._gemini is None:
+            with self.gemini_lock:
+                if self._gemini is None:
+                    try:
+                        self._gemini = genai.Client(api_key=self.gemini_api_key)
+                    except Exception as e:
+                        self.connection_status["gemini"] = f"error: {e}"
+                        raise Exception(f"Gemini client: {str(e)[:50]}")
+        return self._gemini
+
+    def emit(self, event, on_event=None):
+        handler = on_event or self.on_event
+        if handler is not None:
+            handler(event)
+
+    # Messages and topics
+
+    def record_message(self, topic, sender, message, timestamp):
+        # Returns the record's index in the topic, None for an unknown topic
+        with self.history_lock:
+            if topic in self.chat_history:
+                record = {"sender": sender, "message": message, "timestamp": timestamp,
+                          "tokens": estimate_tokens(message)}
+                self.chat_history[topic].append(record)
+                self.history_journal.append(topic, record)
+                return len(self.chat_history[topic]) - 1
+        return None
+
+    def add_message(self, topic, sender, message, on_event=None):
+        timestamp = datetime.datetime.now().strftime("%H:%M")
+        index = self.record_message(topic, sender, message, timestamp)
+        self.emit(("message", topic, sender, message, timestamp), on_event)
+        return index
+
+    def topics(self):
+        with self.history_lock:
+            return list(self.chat_history.keys())
+
+    def create_topic(self, topic):
+        with self.history_lock:
+            if topic not in self.chat_history:
+                self.chat_history[topic] = []
+            self.history_journal.ensure_topic(topic)
+
+    def delete_topic(self, topic):
+        if topic in DEFAULT_TOPICS:
+            raise ValueError("Cannot delete default topics")
+        with self.history_lock:
+            self.chat_history.pop(topic, None)
+            self.history_journal.delete_topic(topic)
+
+    def clear_topic(self, topic):
+        with self.history_lock:
+            self.chat_history[topic] = []
+            self.history_journal.clear_topic(topic)
+
+    def load_history(self):
+        # Imports a pre-journal chat_history.json once, then registers every
+        # journaled topic without reading its messages
+        legacy = self.data_dir / "chat_history.json"
+        if legacy.exists() and not self.history_journal.topics():
+            with open(legacy, 'r', encoding='utf-8') as f:
+                self.history_journal.import_legacy(json.load(f))
+            legacy.replace(legacy.with_suffix(".json.bak"))
+        
+        topics = self.history_journal.topics()
+        with self.history_lock:
+            for topic in topics:
+                self.chat_history.add_unloaded(topic)
+        return topics
+
+    def search(self, query, topic=None, limit=50):
+        # Ranked hits across all topics (or one); messages from the last
+        # moment may not be indexed yet
+        with self.metrics.timer("buddy_search_seconds"):
+            return self.search_index.search(query, topic, limit)
+
+    def save_history(self, wait=False):
+        # Messages are journaled as they are added; this only asks the
+        # journal's writer thread to sync to disk and compact cleared topics
+        self.history_journal.request_sync(wait)
+
+    # Attached files
+
+    def start_ingest(self, files):
+        self.uploaded_files = list(files)
+        self.file_contents = {}
+        self.file_images = []
+        self.file_retriever.clear()
+        self.ingest_generation += 1
+        return self.ingest_generation
+
+    def ingest_files(self, files, generation, progress=None):
+        # Cached files are read straight from disk; the rest are streamed into
+        # the cache on the process pool, and images are encoded for sending.
+        # Returns (previews, retriever, images), or None if a newer upload
+        # replaced this one.
+        start = time.perf_counter()
+        documents = {}
+        pending = []
+        for file_path in files:
+            cached = self.file_text_cache.get(file_path)
+            if cached is None:
+                pending.append(file_path)
+            else:
+                documents[file_path] = cached
+        self.metrics.inc("buddy_ingest_files_total", len(documents), source="cache")
+        self.metrics.inc("buddy_ingest_files_total", len(pending), source="extracted")
+        if progress:
+            progress(len(documents), len(files))
+        
+        for file_path, document in self.extract_pending(pending):
+            if generation != self.ingest_generation:
+                return None
+            documents[file_path] = document
+            if progress:
+                progress(len(documents), len(files))
+        
+        with self.metrics.timer("buddy_index_seconds"):
+            retriever = FileRetriever()
+            retriever.build([(Path(file_path).name, documents[file_path][0]) for file_path in files])
+        previews = {file_path: documents[file_path][1] for file_path in files}
+        self.file_text_cache.prune()
+        images = self.encode_images([path for path in files if Path(path).suffix.lower() in IMAGE_EXTENSIONS])
+        if generation != self.ingest_generation:
+            return None
+        self.metrics.observe("buddy_ingest_seconds", time.perf_counter() - start)
+        self.metrics.inc("buddy_ingest_bytes_total", sum(os.path.getsize(path) for path in files
+                                                          if os.path.exists(path)))
+        return previews, retriever, images
+
+    def encode_images(self, paths):
+        # Images decode and resize mostly outside the GIL, so a few encode at once
+        if not paths:
+            return []
+        start = time.perf_counter()
+
+        def encode(path):
+            try:
+                return self.image_encoder.encode(path)
+            except Exception as e:
+                self.metrics.record_error("image", f"{Path(path).name}: {e}")
+                return None, False
+
+        with ThreadPoolExecutor(max_workers=min(4, len(paths))) as pool:
+            results = list(pool.map(encode, paths))
+        images = []
+        for image, cached in results:
+            if image is None:
+                continue
+            images.append(image)
+            self.metrics.inc("buddy_image_encode_total", result="cache" if cached else "encoded")
+            self.metrics.inc("buddy_image_bytes_total", image.original_bytes, kind="original")
+            self.metrics.inc("buddy_image_bytes_total", len(image.data), kind="sent")
+        self.image_encoder.prune()
+        self.metrics.observe("buddy_image_encode_seconds", time.perf_counter() - start)
+        return images
+
+    def extract_pending(self, paths):
+        # Yields (file_path, (source, preview)) as each extraction finishes
+        remaining = []
+        for path in paths:
+            cache_path = self.file_text_cache.path_for(path)
+            if cache_path is None:
+                preview = extract_file_text(path)
+                yield path, (preview.encode("utf-8"), preview)
+            else:
+                remaining.append((path, cache_path))
+        try:
+            if self.ingest_pool is None:
+                self.ingest_pool = ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+            futures = {self.ingest_pool.submit(extract_to_cache, path, str(cache_path)): (path, cache_path)
+                       for path, cache_path in remaining}
+            for future in as_completed(futures):
+                preview = future.result()
+                remaining.remove(futures[future])
+                yield futures[future][0], (futures[future][1], preview)
+        except Exception as e:
+            # No usable process pool (e.g. a restricted sandbox): extract in this thread
+            print(f"Ingest pool unavailable: {e}")
+            self.ingest_pool = None
+        for path, cache_path in remaining:
+            yield path, (cache_path, extract_to_cache(path, str(cache_path)))
+
+    def finish_ingest(self, generation, previews, retriever, images=()):
+        if generation != self.ingest_generation:
+            return False
+        self.file_contents = previews
+        self.file_retriever = retriever
+        self.file_images = list(images)
+        return True
+
+    def attach_files(self, files, progress=None):
+        generation = self.start_ingest(files)
+        result = self.ingest_files(list(files), generation, progress)
+        return result is not None and self.finish_ingest(generation, *result)
+
+    def clear_files(self):
+        self.uploaded_files = []
+        self.file_contents = {}
+        self.file_images = []
+        self.file_retriever.clear()
+        self.ingest_generation += 1
+
+    def get_file_context(self, topic, user_message, model, on_event=None):
+        # Returns (prefix, excerpts): whole files are the same every turn and
+        # belong in the stable system prefix; excerpts depend on the question
+        # and travel with it
+        if not self.file_contents:
+            return "", ""
+        budget = min(self.context_token_budget, self.model_token_limits.get(model, self.context_token_budget))
+        if self.file_retriever.total_tokens <= budget:
+            context = "\n\n=== FILES ===\n"
+            for name, content in self.file_retriever.documents():
+                context += f"\nFile: {name}\n{content}\n"
+            return context + "\n=== END FILES ===\n", ""
+        
+        with self.metrics.timer("buddy_retrieval_seconds"):
+            chunks, used = self.file_retriever.select(user_message, budget)
+        self.add_message(topic, "system", f"File context trimmed to {used:,} of {self.file_retriever.total_tokens:,} "
+                                          f"tokens ({len(chunks)} of {len(self.file_retriever)} excerpts)",
+                         on_event)
+        context = "=== FILES (relevant excerpts) ===\n"
+        for name, text in chunks:
+            context += f"\nFile: {name}\n{text}\n"
+        return "", context + "\n=== END FILES ===\n\n"
+
+    # Responses
+
+    def local_reply(self, message):
+        # Answers that need no model; None means the message goes to the model
+        routed = self.intents.route(message)
+        if routed is None:
+            return None
+        self.metrics.inc("buddy_local_replies_total", intent=routed[0])
+        return routed[1]
+
+    def conversation_window(self, topic, model=None, end=None):
+        # Returns (summary, [(sender, message)] oldest first): the newest turns
+        # before index `end` (the new question's record; None for the whole
+        # topic) that fit the token budget, plus the topic's rolling summary
+        # of everything older. With a model given, turns that fell out of the
+        # window are queued for summarising.
+        budget = min(self.history_token_budget, self.model_token_limits.get(model, self.history_token_budget))
+        with self.history_lock:
+            if topic not in self.chat_history:
+                return "", []
+            messages = self.chat_history[topic]
+            summary = self.history_journal.summary(topic)
+            # The prompt carries the new message itself; records added after it
+            # (status lines, other models' replies in compare mode) are not
+            # part of its context
+            end = len(messages) if end is None else min(end, len(messages))
+            covered = min(summary["covered"], end) if summary else 0
+            turns = []
+            used = 0
+            start = end
+            while start > covered:
+                msg = messages[start - 1]
+                if msg["sender"] in ("user", "buddy"):
+                    tokens = message_tokens(msg)
+                    if used + tokens > budget:
+                        if not turns:
+                            # One oversized turn: keep its end rather than nothing
+                            turns.append((msg["sender"], "..." + msg["message"][-(budget * 4):]))
+                            start -= 1
+                        break
+                    turns.append((msg["sender"], msg["message"]))
+                    used += tokens
+                start -= 1
+            overflow = sum(message_tokens(msg) for msg in messages[covered:start]
+                           if msg["sender"] in ("user", "buddy"))
+        
+        if model and overflow >= self.summary_batch_tokens:
+            self.schedule_summary(topic, model, start)
+        return (summary["text"] if summary else ""), turns[::-1]
+
+    def build_prompt(self, topic, user_message, model, on_event=None, message_index=None):
+        # Stable parts first (instructions, whole files, summary), then the
+        # conversation as role-tagged turns, then the new message.
+        # message_index is where the question was recorded in the topic.
+        files, excerpts = self.get_file_context(topic, user_message, model, on_event)
+        summary, turns = self.conversation_window(topic, model, message_index)
+        system = SYSTEM_PROMPT + files
+        if summary:
+            system += f"\n\nSummary of the earlier conversation:\n{summary}"
+        prompt = ChatPrompt(system, images=self.file_images)
+        for sender, message in turns:
+            prompt.add("user" if sender == "user" else "assistant", message)
+        prompt.add("user", excerpts + user_message)
+        return prompt
+
+    def schedule_summary(self, topic, model, end):
+        with self.history_lock:
+            if topic in self.summarizing:
+                return
+            self.summarizing.add(topic)
+        self.scheduler.submit(model, self.summary_job, topic, model, end, kind="summary")
+
+    def summary_job(self, job, topic, model, end):
+        # Folds messages[covered:end] into the topic's summary
+        try:
+            with self.history_lock:
+                if topic not in self.chat_history:
+                    return None
+                summary = self.history_journal.summary(topic)
+                covered = summary["covered"] if summary else 0
+                previous = summary["text"] if summary else ""
+                turns = [f"{msg['sender']}: {msg['message'][:1600]}"
+                         for msg in self.chat_history[topic][covered:end] if msg["sender"] in ("user", "buddy")]
+            if not turns:
+                return None
+            words = self.summary_token_budget * 3 // 4
+            prompt = ChatPrompt(
+                f"You maintain the running summary of a conversation between a user and Buddy, an assistant. "
+                f"Keep facts, names, decisions and open questions; at most {words} words.",
+                [("user", f"Current summary:\n{previous or '(none)'}\n\nNew turns:\n" + "\n".join(turns) +
+                  "\n\nUpdated summary:")])
+            try:
+                text = self.async_loop.run(self.timed(model, "complete", self.providers[model].complete(prompt)),
+                                           job.cancelled)
+            except Exception as e:
+                print(f"Summary error: {e}")
+                text = None
+            if not text:
+                # No model available: keep a short digest of each turn instead
+                text = "\n".join(filter(None, [previous] + [condense(turn) for turn in turns]))
+            text = text.strip()[-(self.summary_token_budget * 4):]
+            with self.history_lock:
+                current = self.history_journal.summary(topic)
+                # Skip if the topic was cleared or deleted meanwhile
+                if topic in self.chat_history and (current["covered"] if current else 0) == covered \
+                        and end <= len(self.chat_history[topic]):
+                    self.history_journal.set_summary(topic, text, end)
+            return text
+        finally:
+            with self.history_lock:
+                self.summarizing.discard(topic)
+
+    def ask(self, topic, user_message, model, stream=False, cache=False, on_event=None, cancelled=None):
+        # Records the user message and returns a Future for Buddy's reply
+        # (None if the request was cancelled or failed); setting the
+        # cancelled Event abandons the request
+        index = self.add_message(topic, "user", user_message, on_event)
+        reply = self.local_reply(user_message)
+        if reply is not None:
+            self.add_message(topic, "buddy", reply, on_event)
+            future = Future()
+            future.set_result(reply)
+            return future
+        job = self.scheduler.submit(model, self.respond_job, topic, user_message, model, stream, cache,
+                                    on_event, index, cancelled=cancelled)
+        return job.future
+
+    def respond_job(self, job, topic, user_message, model, stream, cache, on_event, message_index):
+        return self.respond(topic, user_message, model, stream, cache, job.cancelled, on_event,
+                            message_index=message_index)
+
+    def respond(self, topic, user_message, model, stream=False, cache=False, cancelled=None, on_event=None,
+                label=None, message_index=None):
+        # `label` prefixes the reply (compare mode) and turns streaming off;
+        # message_index is the question's record in the topic (None if it
+        # was not recorded there)
+        cancelled = cancelled or threading.Event()
+        stream = stream and not label
+        start = time.perf_counter()
+        try:
+            with self.metrics.timer("buddy_prompt_build_seconds"):
+                prompt = self.build_prompt(topic, user_message, model, on_event, message_index)
+            self.metrics.observe("buddy_prompt_tokens", estimate_tokens(prompt.cache_text()), SIZE_BUCKETS,
+                                 provider=model)
+            
+            # Keyed on the whole prompt (summary and turns included), so a hit
+            # means the same question in the same context: a new topic, a
+            # restart or another compare run. Follow-ups are never cached.
+            cache_key = None
+            if cache and not is_follow_up(user_message):
+                cache_key = ResponseCache.make_key(model, prompt.cache_text())
+                cached = self.response_cache.get(cache_key)
+                self.metrics.inc("buddy_cache_requests_total", result="miss" if cached is None else "hit")
+                if cached is not None:
+                    self.add_message(topic, "buddy", label + cached if label else cached, on_event)
+                    return cached
+            
+            self.add_message(topic, "system", f"Generating with {self.ai_models[model]}...", on_event)
+            
+            provider = self.providers[model]
+            if stream and provider.supports_stream:
+                response = self.async_loop.run(
+                    self.stream_response(topic, model, prompt, on_event), cancelled)
+                if cancelled.is_set():
+                    return None
+                if cache_key and response:
+                    self.response_cache.put(cache_key, response)
+                self.note_response(model, response, start)
+                return response
+            
+            if label:
+                # Compare mode already asks every model; no hedging
+                response = self.async_loop.run(
+                    self.timed(model, "complete", provider.complete(prompt)), cancelled)
+            else:
+                response = self.async_loop.run(
+                    self.routed_complete(topic, model, prompt, on_event), cancelled)
+            if cancelled.is_set():
+                return None
+            if cache_key:
+                self.response_cache.put(cache_key, response)
+            self.add_message(topic, "buddy", label + response if label else response, on_event)
+            self.note_response(model, response, start)
+            return response
+        except Exception as e:
+            if not cancelled.is_set():
+                self.metrics.record_error("respond", str(e.__cause__ or e))
+                self.add_message(topic, "error", f"Error: {str(e)[:100]}", on_event)
+            return None
+
+    def note_response(self, model, response, start):
+        self.metrics.observe("buddy_response_seconds", time.perf_counter() - start, provider=model)
+        self.metrics.observe("buddy_response_tokens", estimate_tokens(response or ""), SIZE_BUCKETS, provider=model)
+
+    async def timed(self, model, kind, coro):
+        # kind "complete" times a whole call, "stream" the first chunk
+        start = time.perf_counter()
+        try:
+            result = await coro
+        except asyncio.CancelledError:
+            self.metrics.inc("buddy_requests_total", provider=model, kind=kind, outcome="cancelled")
+            raise  # a cancelled hedge loser says nothing about the provider
+        except Exception as e:
+            self.provider_stats[model].record(kind, time.perf_counter() - start, False)
+            self.metrics.inc("buddy_requests_total", provider=model, kind=kind, outcome="error")
+            self.metrics.record_error(model, str(e.__cause__ or e))
+            raise
+        elapsed = time.perf_counter() - start
+        self.provider_stats[model].record(kind, elapsed, True)
+        self.metrics.inc("buddy_requests_total", provider=model, kind=kind, outcome="ok")
+        name = "buddy_time_to_first_token_seconds" if kind == "stream" else "buddy_request_seconds"
+        self.metrics.observe(name, elapsed, provider=model)
+        return result
+
+    async def hedged(self, model, kind, call, images=False):
+        # Runs call(candidate) for the routing candidates: a backup starts when
+        # the running calls are slower than the hedge delay, or when they all
+        # fail. The first success wins and the others are cancelled.
+        # With images, only providers that accept them are tried.
+        # Returns (winning model, result).
+        candidates = self.routing.candidates(model, images)
+        delay = self.routing.delay(candidates[0], kind)
+        running = {}
+        errors = []
+        reserved = []
+
+        def launch():
+            while candidates:
+                candidate = candidates.pop(0)
+                # The chosen model's slot and token are held by the scheduler
+                # job; backups are skipped rather than waited for when their
+                # provider is at its concurrency limit or rate limited
+                if candidate == model or self.scheduler.reserve(candidate):
+                    if candidate != model:
+                        reserved.append(candidate)
+                    task = asyncio.ensure_future(self.timed(candidate, kind, call(candidate)))
+                    running[task] = candidate
+                    return
+
+        launch()
+        try:
+            while running:
+                hedge = self.routing.hedge and candidates and len(running) < self.routing.max_parallel
+                done, _ = await asyncio.wait(running, timeout=delay if hedge else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch()
+                    continue
+                winner = None
+                for task in done:
+                    candidate = running.pop(task)
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                    elif winner is None:
+                        winner = (candidate, task.result())
+                    elif kind == "stream":
+                        await task.result()[1].aclose()
+                if winner is not None:
+                    if kind == "stream" and winner[0] in reserved:
+                        # The winning backup keeps its slot until its stream is closed
+                        reserved.remove(winner[0])
+                        first, chunks = winner[1]
+                        winner = (winner[0], (first, HeldStream(chunks, self.scheduler, winner[0])))
+                    return winner
+                if not running and self.routing.failover:
+                    launch()
+        finally:
+            for task in running:
+                task.cancel()
+            for candidate in reserved:
+                self.scheduler.release(candidate)
+        raise errors[0]
+
+    def note_failover(self, topic, model, winner, prompt, on_event=None):
+        if winner != model:
+            self.add_message(topic, "system", f"Answered by {self.ai_models[winner]} "
+                                              f"({self.ai_models[model]} was slow or failing)", on_event)
+        if prompt.images and not self.providers[winner].supports_images:
+            self.add_message(topic, "warning", f"{len(prompt.images)} attached image(s) were not sent: "
+                                               f"{self.ai_models[winner]} does not accept images", on_event)
+
+    async def routed_complete(self, topic, model, prompt, on_event=None):
+        winner, response = await self.hedged(model, "complete", lambda m: self.providers[m].complete(prompt),
+                                             bool(prompt.images))
+        self.note_failover(topic, model, winner, prompt, on_event)
+        return response
+
+    async def open_stream(self, model, prompt):
+        # Waits for the first chunk, so streams are raced on time to first token
+        stream = self.providers[model].stream(prompt)
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = ""
+        except BaseException:
+            await stream.aclose()
+            raise
+        return first, stream
+
+    async def stream_response(self, topic, model, prompt, on_event=None):
+        start = time.perf_counter()
+        winner, (first, chunks) = await self.hedged(model, "stream", lambda m: self.open_stream(m, prompt),
+                                                    bool(prompt.images))
+        self.note_failover(topic, model, winner, prompt, on_event)
+        parts = []
+        timestamp = None
+
+        def deliver(chunk):
+            nonlocal timestamp
+            if timestamp is None:
+                timestamp = datetime.datetime.now().strftime("%H:%M")
+                self.emit(("stream_begin", topic, "buddy", timestamp), on_event)
+            parts.append(chunk)
+            self.emit(("stream_chunk", topic, "buddy", chunk), on_event)
+
+        try:
+            if first:
+                deliver(first)
+            async for chunk in chunks:
+                deliver(chunk)
+        except asyncio.CancelledError:
+            if timestamp is not None:
+                parts.append(" [cancelled]")
+                self.emit(("stream_chunk", topic, "buddy", parts[-1]), on_event)
+            raise
+        finally:
+            await chunks.aclose()
+            if timestamp is not None:
+                # Chunks are already delivered; history gets the full message once
+                self.emit(("stream_chunk", topic, "buddy", "\n"), on_event)
+                self.record_message(topic, "buddy", "".join(parts), timestamp)
+            self.metrics.observe("buddy_stream_seconds", time.perf_counter() - start, provider=winner)
+            self.metrics.observe("buddy_stream_chunks", len(parts), SIZE_BUCKETS, provider=winner)
+        
+        if timestamp is None:
+            self.add_message(topic, "buddy", "No response", on_event)
+        return "".join(parts)
+
+    def compare(self, topic, user_message, cache=False, on_event=None, cancelled=None):
+        # Sends one prompt to every model at once; each reply is added as it
+        # arrives, so the total wait is the slowest model rather than the sum.
+        # Records the question like ask(). Returns {model: Future}, or
+        # {"local": Future} when no model is needed.
+        index = self.add_message(topic, "user", user_message, on_event)
+        reply = self.local_reply(user_message)
+        if reply is not None:
+            self.add_message(topic, "buddy", reply, on_event)
+            future = Future()
+            future.set_result(reply)
+            return {"local": future}
+        futures = {}
+        for model, name in self.ai_models.items():
+            job = self.scheduler.submit(model, self.compare_job, topic, user_message, model, cache,
+                                        on_event, f"[{name}]\n", index, cancelled=cancelled)
+            futures[model] = job.future
+        return futures
+
+    def compare_job(self, job, topic, user_message, model, cache, on_event, label, message_index):
+        return self.respond(topic, user_message, model, False, cache, job.cancelled, on_event, label,
+                            message_index)
+
+    # Batch prompts
+
+    def run_batch(self, items, output_path, model="groq", cache=False, progress=None, cancelled=None, window=16):
+        # Answers independent prompts (no topic history, nothing recorded in
+        # a topic) under the scheduler's per-provider limits, appending a JSON
+        # line per finished item to output_path. Items already answered
+        # there are skipped, so an interrupted run resumes where it stopped;
+        # failed ones are asked again. At most `window` items are queued at
+        # once, so chat requests are not stuck behind the whole batch.
+        # Returns the throughput report; progress(report) follows each item.
+        cancelled = cancelled or threading.Event()
+        answered = self.batch_answered(output_path)
+        todo = []
+        for item in items:
+            item_model = item.get("model") or model
+            if item_model not in self.providers:
+                raise ValueError(f"item {item['id']}: unknown model {item_model!r}")
+            key = batch_item_key(item, item_model)
+            if (item["id"], key) not in answered:
+                todo.append((item, item_model, key))
+        report = {"items": len(items), "skipped": len(items) - len(todo), "ok": 0, "failed": 0,
+                  "prompt_tokens": 0, "response_tokens": 0, "seconds": 0.0, "cancelled": False}
+        start = time.perf_counter()
+        queue = iter(todo)
+        pending = {}
+        with open(output_path, 'a', encoding='utf-8') as out:
+            while True:
+                while len(pending) < window and not cancelled.is_set():
+                    entry = next(queue, None)
+                    if entry is None:
+                        break
+                    item, item_model, key = entry
+                    reply = self.local_reply(item["prompt"])
+                    if reply is not None:
+                        future = Future()
+                        future.set_result({"response": reply, "source": "local", "seconds": 0.0,
+                                           "prompt_tokens": 0})
+                    else:
+                        future = self.scheduler.submit(item_model, self.batch_job, item, item_model, cache,
+                                                       kind="batch", cancelled=cancelled).future
+                    pending[future] = entry
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    item, item_model, key = pending.pop(future)
+                    try:
+                        result, error = future.result(), None
+                    except Exception as e:
+                        result, error = None, str(e.__cause__ or e)
+                    if result is None and error is None:
+                        continue  # cancelled: asked again on resume
+                    line = {"id": item["id"], "key": key, "model": item_model, "prompt": item["prompt"]}
+                    if error is None:
+                        line.update(status="ok", **result, response_tokens=estimate_tokens(result["response"]))
+                        report["ok"] += 1
+                        report["prompt_tokens"] += line["prompt_tokens"]
+                        report["response_tokens"] += line["response_tokens"]
+                    else:
+                        line.update(status="error", error=error)
+                        report["failed"] += 1
+                    self.metrics.inc("buddy_batch_items_total", provider=item_model, outcome=line["status"])
+                    out.write(json.dumps(line, ensure_ascii=False) + "\n")
+                    out.flush()
+                    report["seconds"] = time.perf_counter() - start
+                    if progress:
+                        progress(self.batch_throughput(report))
+        report["seconds"] = time.perf_counter() - start
+        report["cancelled"] = cancelled.is_set() and report["ok"] + report["failed"] + report["skipped"] < len(items)
+        return self.batch_throughput(report)
+
+    @staticmethod
+    def batch_throughput(report):
+        seconds = max(report["seconds"], 1e-9)
+        done = report["ok"] + report["failed"]
+        return dict(report, prompts_per_s=done / seconds,
+                    tokens_per_s=(report["prompt_tokens"] + report["response_tokens"]) / seconds,
+                    response_tokens_per_s=report["response_tokens"] / seconds)
+
+    def batch_answered(self, output_path):
+        # (id, key) of the items answered in an earlier run. A line cut short
+        # by a crash is dropped so appends start on a fresh line.
+        answered = set()
+        path = Path(output_path)
+        if not path.exists():
+            return answered
+        with open(path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+                data = data[:data.rfind(b"\n") + 1]
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") == "ok":
+                answered.add((record.get("id"), record.get("key")))
+        return answered
+
+    def batch_job(self, job, item, model, cache):
+        # One item through the model: the reply with its source, time and
+        # prompt size, or None if cancelled
+        start = time.perf_counter()
+        text = item["prompt"]
+        if item.get("file"):
+            cached = self.file_text_cache.get(item["file"])
+            content = cached[1] if cached else extract_file_text(item["file"])
+            budget = min(self.context_token_budget, self.model_token_limits.get(model, self.context_token_budget))
+            text = f"=== FILE: {Path(item['file']).name} ===\n{content[:budget * 4]}\n=== END FILE ===\n\n{text}"
+        prompt = ChatPrompt(SYSTEM_PROMPT, [("user", text)])
+        prompt_tokens = estimate_tokens(prompt.cache_text())
+        cache_key = ResponseCache.make_key(model, prompt.cache_text()) if cache else None
+        response = self.response_cache.get(cache_key) if cache_key else None
+        source = "cache"
+        if response is None:
+            source = "model"
+            response = self.async_loop.run(self.timed(model, "complete", self.providers[model].complete(prompt)),
+                                           job.cancelled)
+            if response is None or job.cancelled.is_set():
+                return None
+            if cache_key:
+                self.response_cache.put(cache_key, response)
+        return {"response": response, "source": source, "seconds": round(time.perf_counter() - start, 4),
+                "prompt_tokens": prompt_tokens}
+
+    # Connection tests
+
+    def test_connection(self, model):
+        return self.async_loop.run(self.check_provider(model))
+
+    async def check_provider(self, model):
+        provider = self.providers.get(model)
+        result = await provider.test() if provider else ("error", "Unknown model")
+        if result[0] == "success":
+            self.connection_status[model] = "working"
+        return result
+
+    async def test_connections(self, models, on_result=None):
+        # All providers are tested at once; on_result(model, result) fires
+        # as each one answers
+        async def check(model):
+            result = await self.check_provider(model)
+            if on_result:
+                on_result(model, result)
+            return model, result
+        return dict(await asyncio.gather(*(check(model) for model in models)))
+
+    def close(self):
+        try:
+            self.history_journal.close()
+        except Exception as e:
+            print(f"Save error: {e}")
+        self.search_index.close()
+        self.scheduler.shutdown()
+        if self.ingest_pool is not None:
+            self.ingest_pool.shutdown(wait=False, cancel_futures=True)
+        self.response_cache.close()
+        self.async_loop.close(self.http.close)
+        for session in self.sessions.values():
+            session.close()
@@ -0,0 +1,360 @@
+"""
+Buddy AI Assistant - headless front end (no Tk)
+
+Usage:
+    python buddy_headless.py ask "Explain BM25" --model groq --stream
+    echo "Summarise this" | python buddy_headless.py ask --attach notes.pdf
+    python buddy_headless.py ask --batch prompts.txt --topic Programming
+    python buddy_headless.py ask "Which is faster, quicksort or mergesort?" --model compare
+    python buddy_headless.py batch questions.jsonl --output answers.jsonl --model groq
+    python buddy_headless.py search "rate limit" --topic Programming
+    python buddy_headless.py serve --port 8765
+
+API keys are read from GEMINI_API_KEY, GROQ_API_KEY and HF_API_KEY.
+
+HTTP API (serve):
+    GET  /health   queue depth and per-provider latency/error rate
+    GET  /topics   topic names
+    GET  /search   ?q=...&topic=...&limit=... ranked matches across all topics
+    GET  /metrics  Prometheus text (/metrics.jsonl for JSON lines)
+    POST /chat     {"message": ..., "topic": ..., "model": ..., "stream": false, "cache": false}
+                   JSON reply, or server-sent events when "stream" is true; model
+                   "compare" asks every model at once and returns "replies"
+                   (or {"local": ...} for questions answered without a model)
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import threading
+import time
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+from buddy_engine import BuddyEngine, read_batch_items
+
+
+def print_event(event):
+    # Buddy's words go to stdout; status lines go to stderr so output can be piped
+    kind = event[0]
+    if kind == "message":
+        _, topic, sender, message, timestamp = event
+        if sender == "buddy":
+            print(message, flush=True)
+        elif sender != "user":
+            print(f"[{sender}] {message}", file=sys.stderr, flush=True)
+    elif kind == "stream_chunk":
+        sys.stdout.write(event[3])
+        sys.stdout.flush()
+
+
+def read_prompts(args):
+    if args.prompt:
+        return [" ".join(args.prompt)]
+    if args.batch:
+        with open(args.batch, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()]
+    return [line.strip() for line in sys.stdin if line.strip()]
+
+
+def run_ask(engine, args):
+    if args.attach:
+        if args.image_max_side:
+            engine.image_encoder.max_side = args.image_max_side
+        if args.image_max_kb:
+            engine.image_encoder.max_bytes = args.image_max_kb * 1024
+        engine.attach_files(args.attach)
+        print(f"[file] Attached {len(engine.file_contents)} file(s)", file=sys.stderr, flush=True)
+        if engine.file_images:
+            print(f"[file] {len(engine.file_images)} image(s) sent to Gemini as "
+                  f"{sum(len(image.data) for image in engine.file_images) / 1024:,.0f} KB", file=sys.stderr, flush=True)
+    failed = 0
+    for prompt in read_prompts(args):
+        # One at a time, so each prompt sees the previous replies as context
+        if args.model == "compare":
+            futures = engine.compare(args.topic, prompt, args.cache, on_event=print_event).values()
+        else:
+            futures = [engine.ask(args.topic, prompt, args.model, args.stream, args.cache, on_event=print_event)]
+        if any(future.result() is None for future in futures):
+            failed += 1
+    return 1 if failed else 0
+
+
+def run_batch(engine, args):
+    # Ctrl+C stops the batch; running it again with the same --output
+    # resumes with the items not yet answered
+    items = read_batch_items(args.input)
+    cancelled = threading.Event()
+    last = [0.0]
+
+    def progress(report):
+        now = time.monotonic()
+        if now - last[0] >= 2:
+            last[0] = now
+            print(f"[batch] {report['ok'] + report['failed'] + report['skipped']}/{report['items']} "
+                  f"({report['failed']} failed), {report['prompts_per_s']:.2f} prompts/s, "
+                  f"{report['tokens_per_s']:.0f} tokens/s", file=sys.stderr, flush=True)
+
+    result = {}
+    worker = threading.Thread(target=lambda: result.update(
+        engine.run_batch(items, args.output, args.model, args.cache, progress, cancelled)), daemon=True)
+    worker.start()
+    try:
+        while worker.is_alive():
+            worker.join(0.2)
+    except KeyboardInterrupt:
+        cancelled.set()
+        worker.join()
+    if not result:
+        return 1
+    print(f"[batch] {result['ok']} answered, {result['failed']} failed, {result['skipped']} already done"
+          f"{' (stopped)' if result['cancelled'] else ''} in {result['seconds']:.1f} s: "
+          f"{result['prompts_per_s']:.2f} prompts/s, {result['tokens_per_s']:.0f} tokens/s "
+          f"({result['response_tokens_per_s']:.0f} generated)", file=sys.stderr, flush=True)
+    return 1 if result["failed"] or result["cancelled"] else 0
+
+
+def run_search(engine, args):
+    # The index catches up with existing history on the writer thread; a
+    # sync request is answered once that pass is done
+    engine.save_history(wait=True)
+    for hit in engine.search(" ".join(args.query), args.topic, args.limit):
+        snippet = " ".join(hit["snippet"].split())
+        print(f"{hit['topic']} #{hit['index']} ({hit['timestamp']} {hit['sender']}): {snippet}")
+    return 0
+
+
+async def read_request(reader):
+    # Minimal HTTP/1.1 request parser: (method, path, query, headers, body),
+    # or None on EOF
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    method, target, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    body = await reader.readexactly(length) if length else b""
+    target = urlsplit(target)
+    return method.upper(), target.path, parse_qs(target.query), headers, body
+
+
+class HeadlessServer:
+    def __init__(self, engine, host="127.0.0.1", port=8765):
+        self.engine = engine
+        self.host = host
+        self.port = port
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        address = server.sockets[0].getsockname()
+        print(f"Buddy API listening on http://{address[0]}:{address[1]}", file=sys.stderr, flush=True)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, query, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self.route(writer, method, path, query, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, writer, method, path, query, body, keep_alive):
+        if method == "GET" and path == "/health":
+            queued, running = self.engine.scheduler.queue_depth()
+            providers = {model: stats.summary() for model, stats in self.engine.provider_stats.items()}
+            await self.send_json(writer, HTTPStatus.OK, {"status": "ok", "queued": queued, "running": running,
+                                                         "providers": providers}, keep_alive)
+        elif method == "GET" and path in ("/metrics", "/metrics.jsonl"):
+            self.engine.scheduler.update_metrics()
+            if path == "/metrics":
+                await self.send_text(writer, self.engine.metrics.prometheus(), "text/plain; version=0.0.4",
+                                     keep_alive)
+            else:
+                await self.send_text(writer, self.engine.metrics.json_lines(), "application/x-ndjson", keep_alive)
+        elif method == "GET" and path == "/topics":
+            await self.send_json(writer, HTTPStatus.OK, {"topics": self.engine.topics()}, keep_alive)
+        elif method == "GET" and path == "/search":
+            try:
+                limit = int(query.get("limit", ["20"])[0])
+            except ValueError:
+                limit = 20
+            results = self.engine.search(query.get("q", [""])[0], query.get("topic", [None])[0], limit)
+            await self.send_json(writer, HTTPStatus.OK, {"results": results}, keep_alive)
+        elif method == "POST" and path == "/chat":
+            await self.chat(writer, body, keep_alive)
+        else:
+            await self.send_json(writer, HTTPStatus.NOT_FOUND, {"error": "not found"}, keep_alive)
+
+    async def chat(self, writer, body, keep_alive):
+        try:
+            request = json.loads(body or b"{}")
+            message = request["message"].strip()
+        except (ValueError, KeyError, AttributeError):
+            await self.send_json(writer, HTTPStatus.BAD_REQUEST, {"error": "expected JSON with a message"}, keep_alive)
+            return
+        topic = request.get("topic", "General Chat")
+        model = request.get("model", "groq")
+        if model not in self.engine.ai_models and model != "compare":
+            await self.send_json(writer, HTTPStatus.BAD_REQUEST, {"error": f"unknown model {model}"}, keep_alive)
+            return
+        if topic not in self.engine.chat_history:
+            self.engine.create_topic(topic)
+
+        # Engine events arrive on worker threads and are handed to this loop
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        cancelled = threading.Event()
+
+        def on_event(event):
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+        if model == "compare":
+            futures = self.engine.compare(topic, message, bool(request.get("cache")),
+                                          on_event=on_event, cancelled=cancelled)
+            future = asyncio.gather(*(asyncio.wrap_future(f) for f in futures.values()))
+        else:
+            future = asyncio.wrap_future(self.engine.ask(
+                topic, message, model, bool(request.get("stream")), bool(request.get("cache")),
+                on_event=on_event, cancelled=cancelled))
+        try:
+            if request.get("stream"):
+                await self.stream_chat(writer, future, events)
+            elif model == "compare":
+                replies = dict(zip(futures, await future))
+                await self.send_json(writer, HTTPStatus.OK, {"replies": replies}, keep_alive)
+            else:
+                reply = await future
+                notes = []
+                while not events.empty():
+                    event = events.get_nowait()
+                    if event[0] == "message" and event[2] not in ("user", "buddy"):
+                        notes.append({"sender": event[2], "message": event[3]})
+                if reply is None:
+                    error = notes[-1]["message"] if notes else "no response"
+                    await self.send_json(writer, HTTPStatus.BAD_GATEWAY, {"error": error, "notes": notes}, keep_alive)
+                else:
+                    await self.send_json(writer, HTTPStatus.OK, {"reply": reply, "notes": notes}, keep_alive)
+        except (ConnectionError, asyncio.CancelledError):
+            # Client went away: drop the queued or in-flight model request
+            cancelled.set()
+            raise
+
+    async def stream_chat(self, writer, future, events):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n\r\n")
+        while True:
+            getter = asyncio.ensure_future(events.get())
+            done, _ = await asyncio.wait({getter, future}, return_when=asyncio.FIRST_COMPLETED)
+            if getter not in done:
+                getter.cancel()
+                if events.empty():
+                    break
+                continue
+            event = getter.result()
+            if event[0] == "stream_chunk":
+                payload = {"type": "chunk", "text": event[3]}
+            elif event[0] == "message" and event[2] != "user":
+                payload = {"type": "message", "sender": event[2], "text": event[3]}
+            else:
+                continue
+            await self.write_chunk(writer, f"data: {json.dumps(payload)}\n\n")
+        await self.write_chunk(writer, "data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def write_chunk(self, writer, text):
+        data = text.encode("utf-8")
+        writer.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        await writer.drain()
+
+    async def send_json(self, writer, status, payload, keep_alive=True):
+        await self.send_text(writer, json.dumps(payload), "application/json", keep_alive, status)
+
+    async def send_text(self, writer, text, content_type, keep_alive=True, status=HTTPStatus.OK):
+        data = text.encode("utf-8")
+        writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                     f"Content-Type: {content_type}\r\n"
+                     f"Content-Length: {len(data)}\r\n"
+                     f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + data)
+        await writer.drain()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Buddy AI Assistant without the desktop window")
+    parser.add_argument("--data-dir", default=".", help="where chat_history/ and the caches live")
+    parser.add_argument("--no-hedge", action="store_true", help="never ask a backup model while waiting")
+    parser.add_argument("--no-failover", action="store_true", help="report provider errors instead of failing over")
+    parser.add_argument("--hedge-delay", type=float, help="seconds before hedging (default: the model's p95)")
+    parser.add_argument("--metrics", help="write metrics on exit (.jsonl appends JSON lines, else Prometheus text)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ask = commands.add_parser("ask", help="answer a prompt, a batch file, or stdin lines")
+    ask.add_argument("prompt", nargs="*")
+    ask.add_argument("--batch", help="file with one prompt per line")
+    ask.add_argument("--model", default="groq", choices=["gemini", "groq", "huggingface", "compare"])
+    ask.add_argument("--topic", default="General Chat")
+    ask.add_argument("--attach", nargs="+", help="files to use as context (images go to Gemini inline)")
+    ask.add_argument("--image-max-side", type=int, help="downscale attached images to this many pixels")
+    ask.add_argument("--image-max-kb", type=int, help="recompress attached images to at most this size")
+    ask.add_argument("--stream", action="store_true")
+    ask.add_argument("--cache", action="store_true")
+
+    batch = commands.add_parser("batch", help="answer every prompt in a JSONL/CSV file, resumably")
+    batch.add_argument("input", help="JSONL or CSV with a prompt (and optional id, model, file) per item")
+    batch.add_argument("--output", "-o", required=True, help="JSONL of answers; also the resume checkpoint")
+    batch.add_argument("--model", default="groq", choices=["gemini", "groq", "huggingface"])
+    batch.add_argument("--cache", action="store_true")
+
+    search = commands.add_parser("search", help="search every topic's history")
+    search.add_argument("query", nargs="+")
+    search.add_argument("--topic", help="only this topic")
+    search.add_argument("--limit", type=int, default=20)
+
+    serve = commands.add_parser("serve", help="run the HTTP API")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    engine = BuddyEngine(args.data_dir)
+    engine.routing.hedge = not args.no_hedge
+    engine.routing.failover = not args.no_failover
+    engine.routing.hedge_delay = args.hedge_delay
+    try:
+        engine.load_history()
+        if args.command == "ask":
+            if args.topic not in engine.chat_history:
+                engine.create_topic(args.topic)
+            return run_ask(engine, args)
+        if args.command == "search":
+            return run_search(engine, args)
+        if args.command == "batch":
+            return run_batch(engine, args)
+        try:
+            asyncio.run(HeadlessServer(engine, args.host, args.port).serve())
+        except KeyboardInterrupt:
+            pass
+        return 0
+    finally:
+        engine.close()
+        if args.metrics:
+            engine.metrics.export(args.metrics)
+
+
+if __name__ == "__main__":
+    sys.exit(main())